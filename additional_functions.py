@@ -1,15 +1,21 @@
-def given_data_is_long_enough(time_horizon, stocks, file_mode_on):
+import numpy as np
+
+def given_data_is_long_enough(time_horizon, price_panel, file_mode_on):
     if not file_mode_on:
         return True
-    for stock in stocks:
-        if len(stock.pricing_info) >= time_horizon:
-            return True
-        else:
-            return False
-    return False
+    if price_panel is None or not len(price_panel.symbols):
+        return False
+    return bool((price_panel.valid_lengths() >= time_horizon).all())
 
 def apply_stock_splits(adj_close, stock_splits):
-    if stock_splits != 0:
-        return adj_close * (1 / (1 * stock_splits))
-    else:
-        return adj_close
\ No newline at end of file
+    return adj_close / np.where(stock_splits != 0, stock_splits, 1)
+
+def parse_grid(grid_spec):
+    """'start,stop,count' -> evenly spaced values, a single number -> one value"""
+    values = [float(value) for value in grid_spec.split(',')]
+    if len(values) == 1:
+        return np.array(values)
+    start, stop, count = values
+    if count < 1 or count != int(count):
+        raise ValueError('Count must be a positive integer')
+    return np.linspace(start, stop, int(count))
@@ -0,0 +1,128 @@
+import logging as log
+import pandas as pd
+import numpy as np
+
+from portfolio import tangent_portfolios, optimal_portfolio_parameters
+from covariance import COVARIANCE_MODELS, returns_covariance, covariance_solver
+
+
+class RollingMoments():
+    """Mean vector and covariance of a sliding window of returns, kept as running sums
+    updated with rank-one (or rank-k for several rows) adds and removes"""
+    def __init__(self, window_returns):
+        window_returns = np.asarray(window_returns, dtype=np.float64)
+        self.count = len(window_returns)
+        self.sums = window_returns.sum(axis=0)
+        self.cross_products = window_returns.T @ window_returns
+
+    def add(self, returns_rows):
+        returns_rows = np.asarray(returns_rows, dtype=np.float64)
+        self.count += len(returns_rows)
+        self.sums += returns_rows.sum(axis=0)
+        self.cross_products += returns_rows.T @ returns_rows
+
+    def remove(self, returns_rows):
+        returns_rows = np.asarray(returns_rows, dtype=np.float64)
+        self.count -= len(returns_rows)
+        self.sums -= returns_rows.sum(axis=0)
+        self.cross_products -= returns_rows.T @ returns_rows
+
+    def mean(self):
+        return self.sums / self.count
+
+    def cov(self):
+        mean = self.mean()
+        return (self.cross_products - self.count * np.outer(mean, mean)) / (self.count - 1)
+
+
+class BacktestResult():
+    """Realized returns, weights, turnover and drawdown of a rolling rebalanced portfolio"""
+    def __init__(self, portfolio_returns, weights, risk_free_asset_weights, turnover):
+        self.portfolio_returns = portfolio_returns
+        self.weights = weights
+        self.risk_free_asset_weights = risk_free_asset_weights
+        self.turnover = turnover
+        self.wealth = (1 + portfolio_returns / 100).cumprod()
+        self.drawdown = self.wealth / self.wealth.cummax() - 1
+
+    def summary(self):
+        return {'periods': len(self.portfolio_returns),
+                'rebalances': len(self.weights),
+                'total_return': (self.wealth.iloc[-1] - 1) * 100,
+                'mean_return': self.portfolio_returns.mean(),
+                'std_dev': self.portfolio_returns.std(),
+                'max_drawdown': self.drawdown.min() * 100,
+                'average_turnover': self.turnover.mean()}
+
+
+def markowitz_weights(mean_returns, cov, risk_free_return, k_risk_factor=None):
+    """Weights of stocks and of risk free asset, the whole budget in tangent portfolio when k is not given"""
+    weights, expected_return, std_dev = tangent_portfolios(mean_returns, covariance_solver(cov), risk_free_return)
+    if not k_risk_factor:
+        return weights[0], 0.0
+    _, _, _, risk_free_asset_weight = \
+        optimal_portfolio_parameters(expected_return[0], std_dev[0], risk_free_return, k_risk_factor)
+    return weights[0] * (1 - risk_free_asset_weight), float(risk_free_asset_weight)
+
+
+def run_backtest(returns, window, rebalance_every, risk_free_return=0, k_risk_factor=None, index=None,
+                 symbols=None, weights_solver=None, recompute_every=50, covariance_model='sample', n_factors=5):
+    """Slides `window` rows over percentage returns, re-solving weights every `rebalance_every` rows and holding
+    them until the next rebalance. Window moments are updated incrementally and recomputed from scratch every
+    `recompute_every` rebalances to bound rounding drift, shrinkage and factor covariances are estimated from
+    each window's rows. `weights_solver(mean, cov)` returns (stock weights, risk free weight) and defaults to
+    the Markowitz optimal portfolio"""
+    returns = np.asarray(returns, dtype=np.float64)
+    periods, n_stocks = returns.shape
+    if periods <= window:
+        raise ValueError(f'Backtest needs more than {window} periods of returns, got {periods}')
+    if covariance_model not in COVARIANCE_MODELS:
+        raise ValueError(f'Unknown covariance model {covariance_model}, possible choices: '
+                         f'{", ".join(COVARIANCE_MODELS)}')
+    if weights_solver is None:
+        weights_solver = lambda mean, cov: markowitz_weights(mean, cov, risk_free_return, k_risk_factor)
+    index = pd.RangeIndex(periods) if index is None else index
+    symbols = list(range(n_stocks)) if symbols is None else symbols
+
+    portfolio_returns = np.empty(periods - window)
+    rebalance_dates, weights_history, risk_free_asset_weights, turnover = [], [], [], []
+    previous_weights = np.zeros(n_stocks + 1)
+    moments = None
+    for rebalance_number, start in enumerate(range(window, periods, rebalance_every)):
+        if moments is None or rebalance_every >= window or rebalance_number % recompute_every == 0:
+            moments = RollingMoments(returns[start - window:start])
+        else:
+            moments.add(returns[start - rebalance_every:start])
+            moments.remove(returns[start - rebalance_every - window:start - window])
+        if covariance_model == 'sample':
+            cov = moments.cov()
+        else:
+            cov = returns_covariance(returns[start - window:start], covariance_model, n_factors)
+        weights, risk_free_asset_weight = weights_solver(moments.mean(), cov)
+
+        all_weights = np.append(weights, risk_free_asset_weight)
+        turnover.append(np.abs(all_weights - previous_weights).sum())
+        previous_weights = all_weights
+        rebalance_dates.append(index[start])
+        weights_history.append(weights)
+        risk_free_asset_weights.append(risk_free_asset_weight)
+
+        end = min(start + rebalance_every, periods)
+        portfolio_returns[start - window:end - window] = \
+            returns[start:end] @ weights + risk_free_asset_weight * risk_free_return
+
+    return BacktestResult(pd.Series(portfolio_returns, index=index[window:]),
+                          pd.DataFrame(np.array(weights_history), index=rebalance_dates, columns=symbols),
+                          pd.Series(risk_free_asset_weights, index=rebalance_dates),
+                          pd.Series(turnover, index=rebalance_dates))
+
+
+def backtest_panel(panel, window, rebalance_every, risk_free_return=0, k_risk_factor=None, **kwargs):
+    """Backtests over a PricePanel, rows with missing returns are skipped"""
+    returns = panel.returns()
+    complete_rows = ~np.isnan(returns).any(axis=1)
+    if not complete_rows.all():
+        log.warning(f'Skipping {int((~complete_rows).sum())} periods with missing returns in backtest.')
+    return run_backtest(returns[complete_rows], window, rebalance_every, risk_free_return, k_risk_factor,
+                        index=panel.index[1:][complete_rows], symbols=panel.symbols, **kwargs)
+
@@ -0,0 +1,302 @@
+import multiprocessing as mp
+import logging as log
+import contextlib
+import pandas as pd
+import numpy as np
+import json
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from constrained import PortfolioConstraints, constrained_portfolios, constrained_portfolio_parameters
+from covariance import estimate_covariance, covariance_solver
+from file_loader import load_price_file
+from instrumentation import span, add_hook, emit, enabled, traces_memory, SpanRecorder
+from functions import Wallet, N_DAYS_RETURNS_MAP, DEFAULT_CACHE_DIR
+from panel import PricePanel
+from portfolio import tangent_portfolios, optimal_portfolio_parameters
+from price_cache import PriceHistoryCache, panel_from_cache
+from providers import YahooProvider, DataFetchError, DEFAULT_REQUESTS_PER_SECOND
+
+WALLET_SETTINGS = ['k_risk_factor', 'risk_free_asset_expected_return', 'time_horizon_in_days', 'n_days_return_str',
+                   'budget', 'covariance_model', 'n_factors', 'long_only', 'max_asset_weight', 'max_leverage']
+PANEL_ARRAYS = ['close', 'dividends', 'splits']
+BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+_shared_panels = {}
+# spans of the worker process, returned with every result when the parent records metrics
+_span_recorder = None
+
+
+def wallet_settings(wallet_spec):
+    """Wallet defaults overridden by the spec, same names as Wallet attributes. k_risk_factor has no usable default"""
+    if 'k_risk_factor' not in wallet_spec:
+        raise ValueError('k_risk_factor is required')
+    defaults = Wallet()
+    settings = {name: wallet_spec.get(name, getattr(defaults, name)) for name in WALLET_SETTINGS}
+    if settings['k_risk_factor'] <= 0:
+        raise ValueError('k_risk_factor must be greater than zero')
+    if settings['n_days_return_str'] not in N_DAYS_RETURNS_MAP:
+        raise ValueError(f'n_days_return_str must be one of {", ".join(N_DAYS_RETURNS_MAP)}')
+    return settings
+
+
+def data_source(wallet_spec):
+    """Wallets with the same data source share one daily price panel, other intervals are derived from it"""
+    if 'file' in wallet_spec:
+        return ('file', os.path.abspath(wallet_spec['file']))
+    return ('api',)
+
+
+class SharedPanel():
+    """Price panel arrays copied once into shared memory, worker processes map them without copying"""
+    def __init__(self, panel):
+        self.memory_blocks = []
+        self.descriptor = {'index': panel.index, 'symbols': panel.symbols, 'dtype': panel.dtype.str, 'arrays': {}}
+        for name in PANEL_ARRAYS:
+            array = getattr(panel, name)
+            if array is None:
+                continue
+            memory_block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=memory_block.buf)[:] = array
+            self.memory_blocks.append(memory_block)
+            self.descriptor['arrays'][name] = (memory_block.name, array.shape)
+
+    def release(self):
+        for memory_block in self.memory_blocks:
+            memory_block.close()
+            memory_block.unlink()
+
+
+def attach_shared_panel(descriptor):
+    arrays, memory_blocks = {}, []
+    for name, (memory_block_name, shape) in descriptor['arrays'].items():
+        memory_block = shared_memory.SharedMemory(name=memory_block_name)
+        memory_blocks.append(memory_block)
+        arrays[name] = np.ndarray(shape, dtype=descriptor['dtype'], buffer=memory_block.buf)
+    panel = PricePanel(descriptor['index'], descriptor['symbols'], arrays['close'], arrays.get('dividends'),
+                       arrays.get('splits'), dtype=descriptor['dtype'])
+    panel.memory_blocks = memory_blocks
+    return panel
+
+
+@contextlib.contextmanager
+def single_threaded_blas():
+    """Worker processes already use every core, their BLAS is kept to one thread. BLAS reads its thread count
+    from the environment when numpy is imported, before any initializer runs, so the variables are set here
+    for spawned workers to inherit and restored once the pool is done (values set by the user are kept)"""
+    previous = {variable: os.environ.get(variable) for variable in BLAS_THREAD_VARIABLES}
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ.setdefault(variable, '1')
+    try:
+        yield
+    finally:
+        for variable, value in previous.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
+def init_worker(descriptors, metrics=False, trace_memory=False):
+    """Attaches the shared panels and starts recording spans when the parent records metrics"""
+    global _span_recorder
+    if metrics:
+        _span_recorder = SpanRecorder()
+        add_hook(_span_recorder, trace_memory)
+    for source, descriptor in descriptors.items():
+        _shared_panels[source] = attach_shared_panel(descriptor)
+
+
+def evaluate_wallet(panel, settings):
+    """Optimal portfolio of one wallet configuration over (a subset of) a price panel"""
+    risk_free_return = settings['risk_free_asset_expected_return'] * \
+        N_DAYS_RETURNS_MAP[settings['n_days_return_str']] / 365
+    with span('covariance', model=settings['covariance_model']):
+        cov = estimate_covariance(panel, settings['covariance_model'], settings['n_factors'])
+        mean_returns = panel.mean_returns()
+    constraints = PortfolioConstraints(settings['long_only'], settings['max_asset_weight'], settings['max_leverage'])
+    with span('solve', constrained=constraints.active):
+        cov_solver = covariance_solver(cov)
+        if constraints.active:
+            constrained_weights, _ = constrained_portfolios(mean_returns, cov_solver, risk_free_return,
+                                                            settings['k_risk_factor'], constraints)
+            weights, tangent_expected_return, tangent_std_dev, optimal_expected_return, optimal_std_dev, \
+                risk_free_asset_weight = constrained_portfolio_parameters(constrained_weights, mean_returns,
+                                                                          cov_solver, risk_free_return)
+        else:
+            weights, tangent_expected_return, tangent_std_dev = \
+                tangent_portfolios(mean_returns, cov_solver, risk_free_return)
+            _, optimal_std_dev, optimal_expected_return, risk_free_asset_weight = optimal_portfolio_parameters(
+                tangent_expected_return, tangent_std_dev, risk_free_return, settings['k_risk_factor'])
+    return portfolio_result(panel.symbols, constraints, settings['budget'], weights, tangent_expected_return,
+                            tangent_std_dev, optimal_expected_return, optimal_std_dev, risk_free_asset_weight)
+
+
+def portfolio_result(symbols, constraints, budget, weights, tangent_expected_return, tangent_std_dev,
+                     optimal_expected_return, optimal_std_dev, risk_free_asset_weight):
+    """Result of one wallet as batch mode and server mode report it, from parameters of a one-row solve"""
+    risk_free_asset_weight = float(np.ravel(risk_free_asset_weight)[0])
+    risk_assets_weight = 1 - risk_free_asset_weight
+    return {'symbols': symbols,
+            'constraints': str(constraints),
+            'risk_assets_weights': weights[0].tolist(),
+            'tangent_portfolio_expected_return': float(np.ravel(tangent_expected_return)[0]),
+            'tangent_portfolio_std_dev': float(np.ravel(tangent_std_dev)[0]),
+            'optimal_portfolio_expected_return': float(np.ravel(optimal_expected_return)[0]),
+            'optimal_portfolio_std_dev': float(np.ravel(optimal_std_dev)[0]),
+            'risk_free_asset_weight': risk_free_asset_weight,
+            'optimal_portfolio_risk_assets_weight': float(risk_assets_weight),
+            'risk_assets_investments': (weights[0] * risk_assets_weight * budget).tolist(),
+            'risk_free_asset_investment': float(risk_free_asset_weight * budget)}
+
+
+def wallet_rows(panel, settings, source):
+    """Rows of the shared panel a wallet takes data from, last days in API mode and last rows in file mode"""
+    if source[0] == 'file':
+        return slice(max(len(panel) - settings['time_horizon_in_days'], 0), None)
+    window_start = pd.Timestamp.today().normalize() - pd.Timedelta(days=settings['time_horizon_in_days'])
+    return slice(panel.index.searchsorted(window_start), None)
+
+
+def evaluate_wallet_task(name, source, settings, symbols):
+    """Returns (result, spans recorded while evaluating it)"""
+    try:
+        panel = _shared_panels[source]
+        interval = settings['n_days_return_str']
+        with span('returns', interval=interval):
+            wallet_panel = panel.subset(symbols, wallet_rows(panel, settings, source))\
+                .resample(interval, N_DAYS_RETURNS_MAP[interval])
+        result = {'name': name, **evaluate_wallet(wallet_panel, settings)}
+    except Exception as e:
+        result = {'name': name, 'error': str(e)}
+    return result, _span_recorder.take() if _span_recorder else []
+
+
+def load_panels(wallets, cache_dir=None, dtype=np.float64, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    """One daily panel per data source: whole file in file mode, union of symbols over the longest horizon in API mode.
+    Returns (panels, failures), failures are error messages keyed by positions of wallets whose data cannot be loaded"""
+    api_requests = {}
+    panels, source_errors = {}, {}
+    for wallet in wallets:
+        source = wallet['source']
+        if source[0] == 'file' and source not in panels and source not in source_errors:
+            try:
+                with span('fetch', source='file'):
+                    symbols, prices = load_price_file(source[1], dtype=dtype)
+                panels[source] = PricePanel.from_prices(symbols, prices, dtype=dtype)
+            except (OSError, ValueError) as e:
+                source_errors[source] = str(e)
+        elif source[0] == 'api':
+            symbols, days = api_requests.get(source, ({}, 0))
+            symbols.update(dict.fromkeys(wallet['symbols']))
+            api_requests[source] = symbols, max(days, wallet['settings']['time_horizon_in_days'])
+
+    symbol_errors = {}
+    if api_requests:
+        price_cache = PriceHistoryCache(cache_dir or DEFAULT_CACHE_DIR)
+        data_provider = YahooProvider(requests_per_second)
+        for source, (symbols, days) in api_requests.items():
+            symbols = list(symbols)
+            # symbols that fail are dropped, the rest is already cached when fetched again
+            while symbols:
+                try:
+                    with span('fetch', source='api', stocks=len(symbols)):
+                        panels[source] = panel_from_cache(price_cache, data_provider, symbols, '1d', days, dtype=dtype)
+                    break
+                except DataFetchError as e:
+                    symbol_errors.update(e.failures)
+                    symbols = [symbol for symbol in symbols if symbol not in e.failures]
+
+    failures = {}
+    for number, wallet in enumerate(wallets):
+        if wallet['source'] in source_errors:
+            failures[number] = source_errors[wallet['source']]
+        elif wallet['source'][0] == 'api':
+            failed_symbols = {symbol: symbol_errors[symbol] for symbol in wallet['symbols'] if symbol in symbol_errors}
+            if failed_symbols:
+                failures[number] = str(DataFetchError(failed_symbols))
+    return panels, failures
+
+
+def read_batch_spec(spec_path):
+    """{"wallets": [{"name": ..., "symbols": [...] or "file": ..., "k_risk_factor": ..., ...}]}
+    Returns (wallets, failures), failures are error messages keyed by positions of invalid wallets"""
+    with open(spec_path) as spec_file:
+        spec = json.load(spec_file)
+    wallets, failures = [], {}
+    for number, wallet_spec in enumerate(spec['wallets']):
+        name = wallet_spec.get('name', f'wallet_{number}') if isinstance(wallet_spec, dict) else f'wallet_{number}'
+        try:
+            if not isinstance(wallet_spec, dict):
+                raise ValueError('Wallet spec must be a JSON object')
+            wallets.append(read_wallet_spec(wallet_spec, name))
+        except (ValueError, TypeError) as e:
+            wallets.append({'name': name})
+            failures[number] = str(e)
+    return wallets, failures
+
+
+def read_wallet_spec(wallet_spec, default_name):
+    """{"name": ..., "symbols": [...] or "file": ..., "k_risk_factor": ..., ...} of one wallet, validated"""
+    name = wallet_spec.get('name', default_name)
+    settings = wallet_settings(wallet_spec)
+    source = data_source(wallet_spec)
+    if source[0] == 'api' and not wallet_spec.get('symbols'):
+        raise ValueError(f'Wallet {name} needs either "symbols" or "file"')
+    return {'name': name, 'source': source, 'settings': settings, 'symbols': wallet_spec.get('symbols')}
+
+
+def write_results(results, output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'results.json'), 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    rows = [{'wallet': result['name'], 'symbol': symbol, 'weight': weight, 'investment': investment}
+            for result in results if 'error' not in result
+            for symbol, weight, investment in zip(result['symbols'], result['risk_assets_weights'],
+                                                  result['risk_assets_investments'])]
+    rows += [{'wallet': result['name'], 'symbol': 'RISK_FREE', 'weight': result['risk_free_asset_weight'],
+              'investment': result['risk_free_asset_investment']} for result in results if 'error' not in result]
+    pd.DataFrame(rows, columns=['wallet', 'symbol', 'weight', 'investment']).to_csv(
+        os.path.join(output_dir, 'allocations.csv'), index=False)
+
+
+def run_batch(spec_path, output_dir, workers=None, cache_dir=None, dtype=np.float64,
+              requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    """Evaluates every wallet of the spec on a process pool sharing the loaded price panels"""
+    wallets, failures = read_batch_spec(spec_path)
+    # invalid wallets fail alone, the rest is loaded and evaluated
+    valid_numbers = [number for number in range(len(wallets)) if number not in failures]
+    panels, load_failures = load_panels([wallets[number] for number in valid_numbers], cache_dir, dtype,
+                                        requests_per_second)
+    failures.update({valid_numbers[position]: error for position, error in load_failures.items()})
+    log.info(f'Loaded {len(panels)} price panel(s), evaluating {len(wallets) - len(failures)} wallet(s)..')
+
+    shared_panels = {source: SharedPanel(panel) for source, panel in panels.items()}
+    try:
+        # workers are spawned lazily on submits, the environment is kept for the pool's whole life
+        descriptors = {source: shared_panel.descriptor for source, shared_panel in shared_panels.items()}
+        with single_threaded_blas(), ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(), mp_context=mp.get_context('spawn'), initializer=init_worker,
+                initargs=(descriptors, enabled(), traces_memory())) as executor:
+            futures = {number: executor.submit(evaluate_wallet_task, wallet['name'], wallet['source'],
+                                               wallet['settings'], wallet['symbols'])
+                       for number, wallet in enumerate(wallets) if number not in failures}
+            results = []
+            for number, wallet in enumerate(wallets):
+                if number not in futures:
+                    results.append({'name': wallet['name'], 'error': failures[number]})
+                    continue
+                result, spans = futures[number].result()
+                emit(spans, wallet=wallet['name'])
+                results.append(result)
+    finally:
+        for shared_panel in shared_panels.values():
+            shared_panel.release()
+
+    for result in results:
+        if 'error' in result:
+            log.error(f'Cannot calculate portfolio of {result["name"]}! Reason: {result["error"]}')
+    write_results(results, output_dir)
+    log.info(f'Results of {len(results)} wallet(s) saved to {output_dir}')
+    return results
@@ -0,0 +1 @@
+"""Scaling benchmarks of the portfolio pipeline over synthetic datasets, run with python -m benchmarks"""
@@ -0,0 +1,90 @@
+import logging as log
+import pandas as pd
+import numpy as np
+import platform
+import argparse
+import json
+import sys
+
+from benchmarks.pipeline import benchmark_dataset
+from benchmarks.synthetic import synthetic_dataset
+
+DEFAULT_ASSETS = '10,100,1000,10000'
+DEFAULT_DAYS = '250,1000,10000'
+QUICK_ASSETS = '10,100'
+QUICK_DAYS = '250,1000'
+# stages faster than this are noise, they never count as regressions
+MIN_COMPARED_SECONDS = 0.005
+
+
+def parse_sizes(sizes):
+    return [int(size) for size in sizes.split(',')]
+
+
+def run_benchmarks(assets, days, data_dir, seed, repeat, dtype, covariance_model, fetch):
+    results = []
+    for n_days in days:
+        for n_assets in assets:
+            log.warning(f'Benchmarking {n_assets} stocks x {n_days} days..')
+            file_name = synthetic_dataset(data_dir, n_assets, n_days, seed)
+            for stage, measurement in benchmark_dataset(file_name, repeat, dtype, covariance_model, fetch).items():
+                results.append({'assets': n_assets, 'days': n_days, 'stage': stage, **measurement})
+    return results
+
+
+def compare_with_baseline(results, baseline_results, tolerance):
+    """Rows of (assets, days, stage) measured in both runs with time and memory ratios to the baseline"""
+    baseline = {(row['assets'], row['days'], row['stage']): row for row in baseline_results}
+    rows = []
+    for row in results:
+        base = baseline.get((row['assets'], row['days'], row['stage']))
+        if base is None:
+            continue
+        time_ratio = row['seconds'] / base['seconds'] if base['seconds'] else np.inf
+        memory_ratio = row['peak_bytes'] / base['peak_bytes'] if base['peak_bytes'] else np.nan
+        regressed = (time_ratio > tolerance and row['seconds'] > MIN_COMPARED_SECONDS) or memory_ratio > tolerance
+        rows.append({'assets': row['assets'], 'days': row['days'], 'stage': row['stage'],
+                     'seconds': row['seconds'], 'baseline_seconds': base['seconds'], 'time_ratio': time_ratio,
+                     'peak_bytes': row['peak_bytes'], 'baseline_peak_bytes': base['peak_bytes'],
+                     'memory_ratio': memory_ratio, 'regressed': regressed})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='the-wallet benchmarks - time and peak memory of every stage of ' \
+                                                 'the portfolio pipeline over synthetic datasets.')
+    parser.add_argument('--assets', type=str, help=f'Comma separated amounts of stocks (default: {DEFAULT_ASSETS})')
+    parser.add_argument('--days', type=str, help=f'Comma separated amounts of days (default: {DEFAULT_DAYS})')
+    parser.add_argument('--quick', action='store_true', help=f'Small grid ({QUICK_ASSETS} stocks x {QUICK_DAYS} days)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic prices')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per dataset, the best one is reported')
+    parser.add_argument('--data-dir', type=str, default='.benchmark_data', help='Directory of generated datasets')
+    parser.add_argument('--float32', action='store_true', help='Keep prices in single precision')
+    parser.add_argument('--covariance-model', type=str, default='sample', help='Covariance model of the wallet')
+    parser.add_argument('--no-fetch', action='store_true', help='Skip API mode fetch through the price cache')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='Where results are written')
+    parser.add_argument('--baseline', type=str, help='Results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='Time or memory ratio to the baseline ' \
+                                                                     'above which a stage counts as regressed')
+    args = parser.parse_args()
+    log.getLogger().setLevel(log.WARNING)
+
+    assets = parse_sizes(args.assets or (QUICK_ASSETS if args.quick else DEFAULT_ASSETS))
+    days = parse_sizes(args.days or (QUICK_DAYS if args.quick else DEFAULT_DAYS))
+    results = run_benchmarks(assets, days, args.data_dir, args.seed, args.repeat,
+                             'float32' if args.float32 else 'float64', args.covariance_model, not args.no_fetch)
+    with open(args.output, 'w') as output_file:
+        json.dump({'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                                   'pandas': pd.__version__, 'platform': platform.platform(),
+                                   'seed': args.seed, 'covariance_model': args.covariance_model},
+                   'results': results}, output_file, indent=2)
+    print(pd.DataFrame(results).to_string(index=False))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            comparison = compare_with_baseline(results, json.load(baseline_file)['results'], args.tolerance)
+        print()
+        print(comparison.to_string(index=False, float_format='{:.3f}'.format))
+        if len(comparison) and comparison['regressed'].any():
+            log.error(f'{int(comparison["regressed"].sum())} stage(s) regressed against {args.baseline}!')
+            sys.exit(1)
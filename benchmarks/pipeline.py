@@ -0,0 +1,104 @@
+import tempfile
+import tracemalloc
+import time
+import os
+
+from constrained import ConstrainedOptimizer
+from file_loader import load_price_file, SIDECAR_PRICES_SUFFIX, SIDECAR_META_SUFFIX
+from functions import Interface
+from price_cache import PriceHistoryCache, panel_from_cache
+from providers import LocalFakeProvider
+from benchmarks.synthetic import SyntheticHistories
+
+K_RISK_FACTOR = 2
+RISK_FREE_ASSET_EXPECTED_RETURN = 0.04
+
+
+def file_mode_interface(file_name, dtype='float64'):
+    """Interface without menus, the benchmarked methods are the ones the menus call"""
+    interface = Interface.__new__(Interface)
+    interface.file_mode_on = True
+    interface.file_name = file_name
+    interface.file_columns = None
+    interface.panel_dtype = dtype
+    interface.portfolio_optimizer = ConstrainedOptimizer()
+    return interface
+
+
+def remove_sidecar(file_name):
+    for suffix in [SIDECAR_PRICES_SUFFIX, SIDECAR_META_SUFFIX]:
+        if os.path.exists(file_name + suffix):
+            os.remove(file_name + suffix)
+
+
+def load_wallet(interface, covariance_model):
+    interface.load_stocks_info_from_file()
+    wallet = interface.wallet
+    wallet.k_risk_factor = K_RISK_FACTOR
+    wallet.risk_free_asset_expected_return = RISK_FREE_ASSET_EXPECTED_RETURN
+    wallet.risk_free_asset_expected_return_in_given_time_horizon = \
+        wallet.risk_free_asset_expected_return * wallet.n_days_return_as_a_years_part
+    wallet.covariance_model = covariance_model
+
+
+def file_mode_stages(file_name, dtype='float64', covariance_model='sample'):
+    """(stage, function) pairs of the file mode pipeline, to be called in order"""
+    interface = file_mode_interface(file_name, dtype)
+
+    def load_text():
+        remove_sidecar(file_name)
+        load_wallet(interface, covariance_model)
+
+    return [('load_text', load_text),
+            ('load_sidecar', lambda: load_wallet(interface, covariance_model)),
+            ('returns', interface.get_stocks_returns),
+            ('statistics', interface.get_returns_statistics),
+            ('z_matrix', interface.calculate_z_matrix),
+            ('tangent_weights', interface.calculate_tangent_portfolio_weights),
+            ('tangent_std_dev', interface.calculate_tangent_portfolio_std_dev),
+            ('optimal', interface.calculate_optimal_portfolio_weights),
+            ('allocation', interface.compute_budget_allocation)]
+
+
+def api_mode_stages(file_name, cache_dir, dtype='float64'):
+    """(stage, function) pairs fetching the dataset through the price cache from an offline provider"""
+    symbols, prices = load_price_file(file_name)
+    provider = LocalFakeProvider(SyntheticHistories(symbols, prices))
+    price_cache = PriceHistoryCache(cache_dir)
+    # business days of the dataset in calendar days
+    days = len(prices) * 7 // 5 + 7
+    fetch = lambda: panel_from_cache(price_cache, provider, symbols, '1d', days, dtype=dtype)
+    return [('fetch_cold', fetch), ('fetch_warm', fetch)]
+
+
+def measure(stages, trace_memory=False):
+    """Runs stages in order, returns {stage: (wall seconds, cpu seconds, peak bytes allocated or None)}"""
+    measurements = {}
+    for stage, function in stages:
+        if trace_memory:
+            tracemalloc.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        function()
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        peak_bytes = None
+        if trace_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        measurements[stage] = (wall, cpu, peak_bytes)
+    return measurements
+
+
+def benchmark_dataset(file_name, repeat=3, dtype='float64', covariance_model='sample', fetch=True):
+    """Best wall/cpu time of `repeat` runs and peak memory of one traced run for every stage"""
+    def run(trace_memory):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            stages = file_mode_stages(file_name, dtype, covariance_model)
+            if fetch:
+                stages = api_mode_stages(file_name, cache_dir, dtype) + stages
+            return measure(stages, trace_memory)
+
+    timed = [run(False) for _ in range(repeat)]
+    traced = run(True)
+    return {stage: {'seconds': min(timed_run[stage][0] for timed_run in timed),
+                    'cpu_seconds': min(timed_run[stage][1] for timed_run in timed),
+                    'peak_bytes': traced[stage][2]} for stage in traced}
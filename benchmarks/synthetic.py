@@ -0,0 +1,73 @@
+import pandas as pd
+import numpy as np
+import os
+
+from collections.abc import Mapping
+from file_loader import FILE_SEPARATOR
+
+CHUNK_ROWS = 1000
+
+
+def synthetic_symbols(n_assets):
+    return [f'SYN{i:05d}' for i in range(n_assets)]
+
+
+def price_chunks(n_assets, n_days, seed=0, n_factors=3, chunk_rows=CHUNK_ROWS):
+    """Daily prices of correlated stocks (factor model log returns) in chunks of rows, oldest first.
+    The same seed always gives the same prices"""
+    generator = np.random.default_rng(seed)
+    loadings = generator.normal(0, 0.01, (n_assets, n_factors))
+    idiosyncratic_std_devs = generator.uniform(0.005, 0.02, n_assets)
+    drifts = generator.normal(0.0003, 0.0003, n_assets)
+    log_prices = np.log(generator.uniform(10, 500, n_assets))
+    for start in range(0, n_days, chunk_rows):
+        rows = min(chunk_rows, n_days - start)
+        log_returns = drifts + generator.standard_normal((rows, n_factors)) @ loadings.T + \
+            generator.standard_normal((rows, n_assets)) * idiosyncratic_std_devs
+        chunk = log_prices + np.cumsum(log_returns, axis=0)
+        log_prices = chunk[-1]
+        yield np.exp(chunk)
+
+
+def generate_prices(n_assets, n_days, seed=0, n_factors=3):
+    """Returns (symbols, prices array of days x stocks)"""
+    return synthetic_symbols(n_assets), np.vstack(list(price_chunks(n_assets, n_days, seed, n_factors)))
+
+
+def write_price_file(file_name, n_assets, n_days, seed=0, n_factors=3):
+    """Writes a file mode dataset (semicolon separated, header with stock names) chunk by chunk"""
+    with open(file_name, 'w') as price_file:
+        price_file.write(FILE_SEPARATOR.join(synthetic_symbols(n_assets)) + FILE_SEPARATOR + '\n')
+        for chunk in price_chunks(n_assets, n_days, seed, n_factors):
+            np.savetxt(price_file, chunk, fmt='%.4f', delimiter=FILE_SEPARATOR)
+    return file_name
+
+
+def synthetic_dataset(data_dir, n_assets, n_days, seed=0):
+    """Path of a generated dataset, written on first use only"""
+    os.makedirs(data_dir, exist_ok=True)
+    file_name = os.path.join(data_dir, f'synthetic_{n_assets}x{n_days}_seed{seed}.txt')
+    if not os.path.exists(file_name):
+        write_price_file(file_name + '.tmp', n_assets, n_days, seed)
+        os.replace(file_name + '.tmp', file_name)
+    return file_name
+
+
+class SyntheticHistories(Mapping):
+    """Histories for LocalFakeProvider built from a prices array on access, one business day per row ending today.
+    Only the array is kept in memory, whatever the amount of stocks"""
+    def __init__(self, symbols, prices):
+        self.columns = {symbol: column for column, symbol in enumerate(symbols)}
+        self.prices = prices
+        self.dates = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=len(prices))
+
+    def __getitem__(self, symbol):
+        close = np.asarray(self.prices[:, self.columns[symbol]], dtype=np.float64)
+        return pd.DataFrame({'Close': close, 'Dividends': np.zeros_like(close), 'Stock Splits': np.zeros_like(close)},
+                            index=self.dates)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
@@ -0,0 +1,158 @@
+import logging as log
+import numpy as np
+
+from covariance import covariance_solver
+
+PROJECTION_ITERATIONS = 60
+# power iteration approaches the largest eigenvalue from below, the step is kept on the safe side
+LIPSCHITZ_MARGIN = 1.05
+
+
+class PortfolioConstraints():
+    """Limits of the optimal portfolio, weights are parts of the budget. `long_only` forbids short positions,
+    `max_asset_weight` caps every stock and `max_leverage` caps the sum of absolute stock weights
+    (1 means no borrowing at the risk free rate)"""
+    def __init__(self, long_only=False, max_asset_weight=None, max_leverage=None):
+        self.long_only = long_only
+        self.max_asset_weight = max_asset_weight
+        self.max_leverage = max_leverage
+
+    @property
+    def active(self):
+        return self.long_only or self.max_asset_weight is not None or self.max_leverage is not None
+
+    def __str__(self):
+        if not self.active:
+            return 'unconstrained'
+        limits = ['long-only'] if self.long_only else []
+        if self.max_asset_weight is not None:
+            limits.append(f'at most {self.max_asset_weight:.0%} of the budget per stock')
+        if self.max_leverage is not None:
+            limits.append(f'at most {self.max_leverage:.0%} of the budget in stocks')
+        return ', '.join(limits)
+
+    def project(self, weights):
+        """Closest weights satisfying the constraints, for one weight vector or for each row of 2-D weights.
+        Box and leverage together are a soft threshold |w| - t clipped to the box, t found by bisection"""
+        weights = np.asarray(weights, dtype=np.float64)
+        rows = np.atleast_2d(weights)
+        if self.long_only:
+            rows = np.maximum(rows, 0)
+        magnitudes = np.abs(rows)
+        projected = np.clip(magnitudes, 0, self.max_asset_weight)
+        if self.max_leverage is not None:
+            over = projected.sum(axis=1) > self.max_leverage
+            if over.any():
+                over_magnitudes = magnitudes[over]
+                low = np.zeros(len(over_magnitudes))
+                high = over_magnitudes.max(axis=1)
+                for _ in range(PROJECTION_ITERATIONS):
+                    threshold = (low + high) / 2
+                    too_much = np.clip(over_magnitudes - threshold[:, np.newaxis], 0, self.max_asset_weight)\
+                        .sum(axis=1) > self.max_leverage
+                    low = np.where(too_much, threshold, low)
+                    high = np.where(too_much, high, threshold)
+                projected[over] = np.clip(over_magnitudes - high[:, np.newaxis], 0, self.max_asset_weight)
+        return (np.sign(rows) * projected).reshape(weights.shape)
+
+
+def largest_eigenvalue(cov_solver, n_stocks, iterations=200, tolerance=1e-6):
+    """Power iteration with covariance products only, never factorizes or forms the matrix"""
+    vector = np.full(n_stocks, 1 / np.sqrt(n_stocks))
+    estimate = 0
+    for _ in range(iterations):
+        product = cov_solver.multiply(vector)
+        new_estimate = float(vector @ product)
+        norm = np.linalg.norm(product)
+        if norm == 0:
+            return 0
+        vector = product / norm
+        if abs(new_estimate - estimate) <= tolerance * new_estimate:
+            break
+        estimate = new_estimate
+    return new_estimate
+
+
+def constrained_portfolios(mean_returns, cov_solver, risk_free_returns, k_risk_factors, constraints,
+                           initial_weights=None, tolerance=1e-9, max_iterations=10000):
+    """Stock weights (parts of the budget) maximizing w (mu - rf) - k w^T cov w, the utility the closed form
+    maximizes, under constraints. Solved for every (risk free return, k) pair at once (arguments broadcast)
+    by accelerated projected gradient with adaptive restart, rows stop iterating once they converge.
+    Returns (weights with one row per pair, iterations)"""
+    mean_returns = np.asarray(mean_returns, dtype=np.float64)
+    risk_free_returns, k_risk_factors = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(risk_free_returns, dtype=np.float64)),
+        np.atleast_1d(np.asarray(k_risk_factors, dtype=np.float64)))
+    if (k_risk_factors <= 0).any():
+        raise ValueError('Risk factor k must be greater than zero to solve constrained portfolio!')
+    n_portfolios, n_stocks = len(k_risk_factors), len(mean_returns)
+    excess_returns = mean_returns[np.newaxis] - risk_free_returns[:, np.newaxis]
+    lipschitz_constants = 2 * k_risk_factors * max(largest_eigenvalue(cov_solver, n_stocks) * LIPSCHITZ_MARGIN, 1e-300)
+
+    if initial_weights is None:
+        weights = np.zeros((n_portfolios, n_stocks))
+    else:
+        weights = constraints.project(np.broadcast_to(initial_weights, (n_portfolios, n_stocks)))
+    extrapolated = weights.copy()
+    momentum = np.ones(n_portfolios)
+    active = np.arange(n_portfolios)
+    for iteration in range(1, max_iterations + 1):
+        points = extrapolated[active]
+        gradients = 2 * k_risk_factors[active, np.newaxis] * cov_solver.multiply(points) - excess_returns[active]
+        new_weights = constraints.project(points - gradients / lipschitz_constants[active, np.newaxis])
+        change = new_weights - weights[active]
+        new_momentum = (1 + np.sqrt(1 + 4 * momentum[active] ** 2)) / 2
+        # momentum pointing uphill is dropped, keeps warm starts from overshooting
+        restart = ((points - new_weights) * change).sum(axis=1) > 0
+        extrapolation = np.where(restart, 0, (momentum[active] - 1) / new_momentum)
+        momentum[active] = np.where(restart, 1, new_momentum)
+        extrapolated[active] = new_weights + extrapolation[:, np.newaxis] * change
+        weights[active] = new_weights
+        converged = np.abs(change).max(axis=1) <= tolerance * np.maximum(np.abs(new_weights).max(axis=1), 1)
+        active = active[~converged]
+        if not active.size:
+            break
+    else:
+        log.warning(f'Constrained portfolio did not converge in {max_iterations} iterations for '
+                    f'{len(active)} of {n_portfolios} portfolio(s).')
+    return weights, iteration
+
+
+def constrained_portfolio_parameters(weights, mean_returns, cov_solver, risk_free_returns):
+    """Describes constrained weights the way the closed form does: composition of the risk assets part,
+    its expected return and std dev, optimal expected return and std dev, risk free asset weight"""
+    weights = np.asarray(weights, dtype=np.float64)
+    risk_assets_weight = weights.sum(axis=-1)
+    composition = np.divide(weights, risk_assets_weight[..., np.newaxis], out=np.zeros_like(weights),
+                            where=risk_assets_weight[..., np.newaxis] != 0)
+    risk_free_asset_weight = 1 - risk_assets_weight
+    return (composition, composition @ mean_returns, np.sqrt(cov_solver.variance(composition)),
+            weights @ mean_returns + risk_free_asset_weight * risk_free_returns,
+            np.sqrt(cov_solver.variance(weights)), risk_free_asset_weight)
+
+
+class ConstrainedOptimizer():
+    """Starts every solve from the previous solution, so small changes of k, risk free rate or data window
+    converge in a few iterations instead of paying a cold solve"""
+    def __init__(self):
+        self.previous_weights = None
+        self.iterations = 0
+
+    def solve(self, mean_returns, cov_solver, risk_free_returns, k_risk_factors, constraints):
+        n_portfolios = np.broadcast(np.atleast_1d(risk_free_returns), np.atleast_1d(k_risk_factors)).size
+        initial_weights = self.previous_weights
+        if initial_weights is not None and (initial_weights.shape[1] != len(mean_returns) or
+                                            len(initial_weights) not in (1, n_portfolios)):
+            initial_weights = None
+        weights, self.iterations = constrained_portfolios(mean_returns, cov_solver, risk_free_returns, k_risk_factors,
+                                                          constraints, initial_weights)
+        self.previous_weights = weights
+        return weights
+
+    def weights_solver(self, risk_free_return, k_risk_factor, constraints):
+        """`weights_solver(mean, cov)` for the backtest, each rebalance starts from the previous one"""
+        def solve_window(mean_returns, cov):
+            weights = self.solve(mean_returns, covariance_solver(cov), risk_free_return, k_risk_factor,
+                                 constraints)[0]
+            return weights, float(1 - weights.sum())
+        return solve_window
@@ -0,0 +1,137 @@
+import numpy as np
+
+from solvers import CovarianceSolver, CovarianceError
+
+COVARIANCE_MODELS = ['sample', 'shrinkage', 'factor']
+MAX_PRINTED_COV_MATRIX_SIZE = 20
+
+
+def demeaned_returns(returns):
+    """Returns minus column means, gaps filled with the mean (zero after demeaning)"""
+    returns = np.asarray(returns, dtype=np.float64)
+    demeaned = returns - np.nanmean(returns, axis=0)
+    return np.where(np.isnan(demeaned), 0, demeaned)
+
+
+def ledoit_wolf_covariance(returns):
+    """Ledoit-Wolf (2004) shrinkage of sample covariance towards scaled identity"""
+    demeaned = demeaned_returns(returns)
+    periods, n_stocks = demeaned.shape
+    sample_cov = demeaned.T @ demeaned / periods
+    mean_variance = np.trace(sample_cov) / n_stocks
+    sample_cov_norm = (sample_cov ** 2).sum()
+    # ||S - mI||^2 without forming mI
+    dispersion = (sample_cov_norm - 2 * mean_variance * np.trace(sample_cov) + n_stocks * mean_variance ** 2) / n_stocks
+    # sum_t ||x_t x_t^T - S||^2 = sum_t ||x_t||^4 - T ||S||^2
+    estimation_error = (((demeaned ** 2).sum(axis=1) ** 2).sum() - periods * sample_cov_norm) / (periods ** 2 * n_stocks)
+    estimation_error = min(estimation_error, dispersion)
+    shrinkage = estimation_error / dispersion if dispersion > 0 else 1
+    shrunk_cov = (1 - shrinkage) * sample_cov
+    shrunk_cov[np.diag_indices_from(shrunk_cov)] += shrinkage * mean_variance
+    return shrunk_cov
+
+
+class FactorCovariance():
+    """Statistical factor model cov = B B^T + diag(D) with k principal-component factors.
+    Keeps only O(n*k) numbers and solves through the Woodbury identity in O(n*k^2)"""
+    def __init__(self, returns, n_factors):
+        demeaned = demeaned_returns(returns)
+        periods, n_stocks = demeaned.shape
+        if periods < 2:
+            raise CovarianceError('Factor model needs at least two periods of returns!')
+        self.n_factors = max(1, min(n_factors, n_stocks, periods - 1))
+
+        # eigendecomposition of the smaller of the two Gram matrices, T x T when stocks outnumber periods
+        if periods <= n_stocks:
+            eigenvalues, eigenvectors = np.linalg.eigh(demeaned @ demeaned.T)
+            top = np.argsort(eigenvalues)[::-1][:self.n_factors]
+            self.loadings = demeaned.T @ eigenvectors[:, top] / np.sqrt(periods - 1)
+        else:
+            eigenvalues, eigenvectors = np.linalg.eigh(demeaned.T @ demeaned)
+            top = np.argsort(eigenvalues)[::-1][:self.n_factors]
+            self.loadings = eigenvectors[:, top] * np.sqrt(np.maximum(eigenvalues[top], 0) / (periods - 1))
+        self.factor_variances = np.maximum(eigenvalues[top], 0) / (periods - 1)
+
+        total_variances = (demeaned ** 2).sum(axis=0) / (periods - 1)
+        self.explained_variance = self.factor_variances.sum() / total_variances.sum() if total_variances.sum() else 0
+        floor = max(total_variances.mean(), 1e-300) * 1e-8
+        self.idiosyncratic_variances = np.maximum(total_variances - (self.loadings ** 2).sum(axis=1), floor)
+
+        self.scaled_loadings = self.loadings / self.idiosyncratic_variances[:, np.newaxis]
+        self.capacitance = np.eye(self.n_factors) + self.loadings.T @ self.scaled_loadings
+        self.condition_number = (self.factor_variances.max() + self.idiosyncratic_variances.max()) / \
+            self.idiosyncratic_variances.min()
+        self.method = 'woodbury'
+
+    @property
+    def shape(self):
+        return (len(self.idiosyncratic_variances),) * 2
+
+    def diagonal(self):
+        return (self.loadings ** 2).sum(axis=1) + self.idiosyncratic_variances
+
+    def solve(self, vector):
+        """cov^-1 @ vector = D^-1 v - D^-1 B (I + B^T D^-1 B)^-1 B^T D^-1 v"""
+        vector = np.asarray(vector, dtype=np.float64)
+        inverted_diagonal = 1 / self.idiosyncratic_variances.reshape((-1,) + (1,) * (vector.ndim - 1))
+        return inverted_diagonal * vector - \
+            self.scaled_loadings @ np.linalg.solve(self.capacitance, self.scaled_loadings.T @ vector)
+
+    def multiply(self, weights):
+        """cov @ w for one weight vector, or for each row of 2-D weights"""
+        weights = np.asarray(weights, dtype=np.float64)
+        return (weights @ self.loadings) @ self.loadings.T + weights * self.idiosyncratic_variances
+
+    def variance(self, weights):
+        """w^T cov w for one weight vector, or for each row of 2-D weights"""
+        weights = np.asarray(weights, dtype=np.float64)
+        return ((weights @ self.loadings) ** 2).sum(axis=-1) + (weights ** 2) @ self.idiosyncratic_variances
+
+    def to_dense(self):
+        cov_matrix = self.loadings @ self.loadings.T
+        cov_matrix[np.diag_indices_from(cov_matrix)] += self.idiosyncratic_variances
+        return cov_matrix
+
+
+def estimate_covariance(panel, covariance_model='sample', n_factors=5):
+    """Covariance of panel's returns, dense matrix for 'sample'/'shrinkage', FactorCovariance for 'factor'"""
+    if covariance_model == 'sample':
+        return panel.cov_matrix()
+    return returns_covariance(panel.returns(), covariance_model, n_factors)
+
+
+def returns_covariance(returns, covariance_model='sample', n_factors=5):
+    """Covariance of a returns matrix (periods x stocks), same models as estimate_covariance"""
+    if covariance_model == 'sample':
+        return np.atleast_2d(np.cov(np.asarray(returns, dtype=np.float64), rowvar=False))
+    if covariance_model == 'shrinkage':
+        return ledoit_wolf_covariance(returns)
+    if covariance_model == 'factor':
+        return FactorCovariance(returns, n_factors)
+    raise ValueError(f'Unknown covariance model {covariance_model}, possible choices: {", ".join(COVARIANCE_MODELS)}')
+
+
+def covariance_solver(cov):
+    """Factor models solve themselves, dense matrices get factorized"""
+    if isinstance(cov, FactorCovariance):
+        return cov
+    return CovarianceSolver(cov)
+
+
+def summarize_covariance(cov):
+    """Printable covariance, the whole matrix when it is small, a summary otherwise"""
+    if not isinstance(cov, FactorCovariance) and len(cov) <= MAX_PRINTED_COV_MATRIX_SIZE:
+        return str(cov)
+    variances = cov.diagonal() if isinstance(cov, FactorCovariance) else np.diag(cov)
+    summary = f'{cov.shape[0]}x{cov.shape[1]} covariance matrix'
+    if isinstance(cov, FactorCovariance):
+        summary += f' from {cov.n_factors}-factor model explaining {cov.explained_variance * 100:.1f}% of variance'
+    else:
+        std_devs = np.sqrt(np.maximum(variances, 0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            correlations = cov / np.outer(std_devs, std_devs)
+        off_diagonal = correlations[~np.eye(len(cov), dtype=bool)]
+        summary += f'\nCorrelations: min {np.nanmin(off_diagonal):.3f}, mean {np.nanmean(off_diagonal):.3f}, ' \
+                   f'max {np.nanmax(off_diagonal):.3f}'
+    summary += f'\nVariances: min {variances.min():.4g}, median {np.median(variances):.4g}, max {variances.max():.4g}'
+    return summary
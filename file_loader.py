@@ -0,0 +1,249 @@
+import logging as log
+import pandas as pd
+import numpy as np
+import tempfile
+import json
+import os
+
+from instrumentation import count
+
+FILE_SEPARATOR = ';'
+CHUNK_ROWS = 10000
+SIDECAR_PRICES_SUFFIX = '.prices.npy'
+SIDECAR_META_SUFFIX = '.prices.json'
+
+
+def read_header(file_name):
+    """Stock names from the first line, a trailing separator does not make an extra column"""
+    with open(file_name) as price_file:
+        names = price_file.readline().rstrip('\r\n').split(FILE_SEPARATOR)
+    while names and not names[-1].strip():
+        names.pop()
+    return [name.strip() for name in names]
+
+
+def count_lines(file_name):
+    """Upper bound of data rows, used to parse straight into a preallocated array"""
+    with open(file_name, 'rb') as price_file:
+        lines = 0
+        last_block = b''
+        for block in iter(lambda: price_file.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last_block = block
+    return lines + (1 if last_block and not last_block.endswith(b'\n') else 0)
+
+
+def select_columns(symbols, columns):
+    if columns is None:
+        return list(range(len(symbols)))
+    unknown_columns = [column for column in columns if column not in symbols]
+    if unknown_columns:
+        raise ValueError(f'Columns not found in file: {", ".join(unknown_columns)}')
+    return [symbols.index(column) for column in columns]
+
+
+def price_chunks(file_name, selected, dtype=np.float64, chunk_rows=CHUNK_ROWS):
+    """Yields parsed (rows x selected stocks) chunks of a price file, non-numeric and missing values are rejected"""
+    try:
+        reader = pd.read_csv(file_name, sep=FILE_SEPARATOR, header=None, skiprows=1, usecols=selected,
+                             dtype=dtype, chunksize=chunk_rows, engine='c')
+        for chunk in reader:
+            # usecols keeps file order, restore the requested one
+            values = chunk[selected].to_numpy(dtype=dtype)
+            if np.isnan(values).any():
+                raise ValueError
+            yield values
+    except ValueError:
+        raise ValueError('Columns, apart from header, must contain only numeric values!')
+
+
+def parse_price_file(file_name, columns=None, dtype=np.float64, chunk_rows=CHUNK_ROWS):
+    """Parses semicolon separated prices chunk by chunk into one (rows x stocks) array"""
+    symbols = read_header(file_name)
+    selected = select_columns(symbols, columns)
+    prices = np.empty((max(count_lines(file_name) - 1, 0), len(selected)), dtype=dtype)
+    filled = 0
+    for values in price_chunks(file_name, selected, dtype, chunk_rows):
+        prices[filled:filled + len(values)] = values
+        filled += len(values)
+    return [symbols[i] for i in selected], prices[:filled]
+
+
+def sidecar_is_fresh(file_name, dtype=np.float64):
+    """Sidecar exists, was written from the current source file and holds prices of the wanted dtype"""
+    meta_path = file_name + SIDECAR_META_SUFFIX
+    if not os.path.exists(meta_path) or not os.path.exists(file_name + SIDECAR_PRICES_SUFFIX):
+        return False
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError) as e:
+        log.warning(f'Binary sidecar file is corrupt ({e}), parsing the price file again..')
+        return False
+    source = os.stat(file_name)
+    return meta.get('source_size') == source.st_size and meta.get('source_mtime') == source.st_mtime and \
+        meta.get('dtype') == np.dtype(dtype).str
+
+
+def write_sidecar(file_name, dtype=np.float64, chunk_rows=CHUNK_ROWS):
+    """Binary copy of a price file (.npy next to it), later opened memory-mapped instead of parsed. Chunks are
+    parsed straight into the memory-mapped file, so all columns are converted without holding them in memory"""
+    source = os.stat(file_name)
+    symbols = read_header(file_name)
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp_path = tempfile.mkstemp(prefix='.prices.', suffix='.npy.tmp', dir=directory)
+    os.close(fd)
+    try:
+        prices = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                           shape=(max(count_lines(file_name) - 1, 0), len(symbols)))
+        filled = 0
+        for values in price_chunks(file_name, list(range(len(symbols))), dtype, chunk_rows):
+            prices[filled:filled + len(values)] = values
+            filled += len(values)
+        prices.flush()
+        del prices
+        os.replace(tmp_path, file_name + SIDECAR_PRICES_SUFFIX)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    # meta goes last, a sidecar is only used when meta matches the source file and dtype
+    meta = {'symbols': symbols, 'rows': filled, 'dtype': np.dtype(dtype).str, 'source_size': source.st_size,
+            'source_mtime': source.st_mtime}
+    fd, tmp_path = tempfile.mkstemp(prefix='.prices.', suffix='.json.tmp', dir=directory)
+    with os.fdopen(fd, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(tmp_path, file_name + SIDECAR_META_SUFFIX)
+
+
+def open_sidecar(file_name):
+    with open(file_name + SIDECAR_META_SUFFIX) as meta_file:
+        meta = json.load(meta_file)
+    prices = np.load(file_name + SIDECAR_PRICES_SUFFIX, mmap_mode='r')
+    if prices.ndim != 2 or prices.shape[1] != len(meta['symbols']) or len(prices) < meta['rows']:
+        raise ValueError(f'prices of shape {prices.shape} do not match {len(meta["symbols"])} symbols '
+                         f'and {meta["rows"]} rows')
+    # rows are counted from lines before parsing, blank lines leave unused rows at the end
+    return meta['symbols'], prices[:meta['rows']]
+
+
+def load_price_file(file_name, columns=None, dtype=np.float64, use_sidecar=True):
+    """Returns (symbols, prices array) of a file mode dataset. The first load writes a binary sidecar,
+    next loads memory-map it as long as the source file did not change"""
+    if not use_sidecar:
+        count('bytes_fetched', os.path.getsize(file_name))
+        return parse_price_file(file_name, columns, dtype=dtype)
+    symbols = None
+    if sidecar_is_fresh(file_name, dtype):
+        try:
+            symbols, prices = open_sidecar(file_name)
+            log.info('Loading prices from binary sidecar file.')
+            count('bytes_fetched', prices.nbytes)
+        except (OSError, ValueError, KeyError) as e:
+            # a truncated or damaged sidecar is stale, it gets written again
+            log.warning(f'Binary sidecar file is corrupt ({e}), parsing the price file again..')
+    if symbols is None:
+        count('bytes_fetched', os.path.getsize(file_name))
+        try:
+            write_sidecar(file_name, dtype)
+            symbols, prices = open_sidecar(file_name)
+        except OSError as e:
+            log.warning(f'Cannot write binary sidecar file! Reason: {e}')
+            return parse_price_file(file_name, columns, dtype=dtype)
+
+    selected = select_columns(symbols, columns)
+    prices = np.empty((max(count_lines(file_name) - 1, 0), len(selected)), dtype=dtype)
+    filled = 0
+    for values in price_chunks(file_name, selected, dtype, chunk_rows):
+        prices[filled:filled + len(values)] = values
+        filled += len(values)
+    return [symbols[i] for i in selected], prices[:filled]
+
+
+def sidecar_is_fresh(file_name, dtype=np.float64):
+    """Sidecar exists, was written from the current source file and holds prices of the wanted dtype"""
+    meta_path = file_name + SIDECAR_META_SUFFIX
+    if not os.path.exists(meta_path) or not os.path.exists(file_name + SIDECAR_PRICES_SUFFIX):
+        return False
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError) as e:
+        log.warning(f'Binary sidecar file is corrupt ({e}), parsing the price file again..')
+        return False
+    source = os.stat(file_name)
+    return meta.get('source_size') == source.st_size and meta.get('source_mtime') == source.st_mtime and \
+        meta.get('dtype') == np.dtype(dtype).str
+
+
+def write_sidecar(file_name, dtype=np.float64, chunk_rows=CHUNK_ROWS):
+    """Binary copy of a price file (.npy next to it), later opened memory-mapped instead of parsed. Chunks are
+    parsed straight into the memory-mapped file, so all columns are converted without holding them in memory"""
+    source = os.stat(file_name)
+    symbols = read_header(file_name)
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp_path = tempfile.mkstemp(prefix='.prices.', suffix='.npy.tmp', dir=directory)
+    os.close(fd)
+    try:
+        prices = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                           shape=(max(count_lines(file_name) - 1, 0), len(symbols)))
+        filled = 0
+        for values in price_chunks(file_name, list(range(len(symbols))), dtype, chunk_rows):
+            prices[filled:filled + len(values)] = values
+            filled += len(values)
+        prices.flush()
+        del prices
+        os.replace(tmp_path, file_name + SIDECAR_PRICES_SUFFIX)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    # meta goes last, a sidecar is only used when meta matches the source file and dtype
+    meta = {'symbols': symbols, 'rows': filled, 'dtype': np.dtype(dtype).str, 'source_size': source.st_size,
+            'source_mtime': source.st_mtime}
+    fd, tmp_path = tempfile.mkstemp(prefix='.prices.', suffix='.json.tmp', dir=directory)
+    with os.fdopen(fd, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(tmp_path, file_name + SIDECAR_META_SUFFIX)
+
+
+def open_sidecar(file_name):
+    with open(file_name + SIDECAR_META_SUFFIX) as meta_file:
+        meta = json.load(meta_file)
+    prices = np.load(file_name + SIDECAR_PRICES_SUFFIX, mmap_mode='r')
+    if prices.ndim != 2 or prices.shape[1] != len(meta['symbols']) or len(prices) < meta['rows']:
+        raise ValueError(f'prices of shape {prices.shape} do not match {len(meta["symbols"])} symbols '
+                         f'and {meta["rows"]} rows')
+    # rows are counted from lines before parsing, blank lines leave unused rows at the end
+    return meta['symbols'], prices[:meta['rows']]
+
+
+def load_price_file(file_name, columns=None, dtype=np.float64, use_sidecar=True):
+    """Returns (symbols, prices array) of a file mode dataset. The first load writes a binary sidecar,
+    next loads memory-map it as long as the source file did not change"""
+    symbols = None
+    if use_sidecar and sidecar_is_fresh(file_name, dtype):
+        try:
+            symbols, prices = open_sidecar(file_name)
+            log.info('Loading prices from binary sidecar file.')
+            count('bytes_fetched', prices.nbytes)
+        except (OSError, ValueError, KeyError) as e:
+            # truncated or damaged sidecar is stale, it gets written again
+            log.warning(f'Binary sidecar file is corrupt ({e}), parsing the price file again..')
+            symbols = None
+    if symbols is not None:
+        pass
+    elif use_sidecar:
+        count('bytes_fetched', os.path.getsize(file_name))
+        try:
+            write_sidecar(file_name, dtype)
+            symbols, prices = open_sidecar(file_name)
+        except OSError as e:
+            log.warning(f'Cannot write binary sidecar file! Reason: {e}')
+            return parse_price_file(file_name, columns, dtype=dtype)
+    else:
+        count('bytes_fetched', os.path.getsize(file_name))
+        return parse_price_file(file_name, columns, dtype=dtype)
+
+    selected = select_columns(symbols, columns)
+    if columns is not None:
+        prices = prices[:, selected]
+    return [symbols[i] for i in selected], prices
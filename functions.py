@@ -1,26 +1,42 @@
 import logging as log
-import yfinance as yf
-import pickle as pkl
 import pandas as pd
 import numpy as np
+import time
 
 from math import sqrt
-from additional_functions import apply_stock_splits, given_data_is_long_enough
+from additional_functions import given_data_is_long_enough, parse_grid
+from file_loader import load_price_file
+from wallet_store import save_wallet, load_wallet, load_legacy_wallet, WalletFormatError
+from panel import PricePanel
+from price_cache import PriceHistoryCache, panel_from_cache
+from providers import YahooProvider, DataFetchError, fetch_concurrently
+from stages import StageGraph
+from solvers import CovarianceError
+from covariance import COVARIANCE_MODELS, estimate_covariance, covariance_solver, summarize_covariance
+from portfolio import optimal_portfolio_parameters
+from sweep import sweep_portfolios, export_sweep
+from backtest import backtest_panel
+from constrained import PortfolioConstraints, ConstrainedOptimizer, constrained_portfolio_parameters
+from simulation import simulate_portfolio
+from instrumentation import span
 from os import path
 
 CURRENT_FILE_DIR = path.dirname(path.realpath(__file__))
+DEFAULT_CACHE_DIR = path.join(CURRENT_FILE_DIR, '.price_cache')
 log.basicConfig(format='%(levelname)s| %(message)s', level=log.INFO)
 
 N_DAYS_RETURNS_MAP = {'1d' : 1, '1wk' : 7, '1mo' : 30, '3mo' : 90}
 
 class Stock():
-    """Used only in file mode to emulate stock from API"""
-    def __init__(self, symbol, close_prices):
+    """Used only in file mode to emulate stock from API, prices are kept in wallet's file_prices panel"""
+    def __init__(self, symbol):
         self.info = {'symbol': symbol, 'shortName': symbol}
-        self.pricing_info = pd.DataFrame()
-        self.pricing_info['Close'] = close_prices
-        self.pricing_info['Dividends'] = 0
-        self.pricing_info['Stock Splits'] = 0
+
+
+class ApiStock():
+    """Used in API mode, prices are fetched through the data provider when needed"""
+    def __init__(self, info):
+        self.info = info
 
 
 class Wallet():
@@ -28,6 +44,12 @@ class Wallet():
     def __init__(self):
         self.stocks = []
         self.stocks_returns = pd.DataFrame()
+        self.price_panel = None
+        self.returns_panel = None
+        self.file_prices = None
+        self.prices_fetched_at = None
+        self.panel_dtype = 'float64'
+        self.stages = StageGraph()
         self.k_risk_factor = 0
         self.risk_free_asset_expected_return = 0
         self.risk_assets_weights = []
@@ -37,8 +59,16 @@ class Wallet():
         self.n_days_return = N_DAYS_RETURNS_MAP[self.n_days_return_str]
         self.n_days_return_as_a_years_part = self.n_days_return / 365
         self.budget = 100
+        self.covariance_model = 'sample'
+        self.n_factors = 5
+        self.long_only = False
+        self.max_asset_weight = None
+        self.max_leverage = None
         self.file_mode_on = False
 
+    def constraints(self):
+        return PortfolioConstraints(self.long_only, self.max_asset_weight, self.max_leverage)
+
     def __str__(self):
         wallet_info = 'Stocks in your wallet:'
         if not self.stocks:
@@ -52,50 +82,67 @@ class Wallet():
         wallet_info += '\n' + f'You will currently calculate the portfolio for stocks\' means and variances ' \
                               f'from results from the last {self.time_horizon_in_days} days.'
         wallet_info += '\n' + f'You will currently calculate the portfolio for calculated {self.n_days_return}-day(s) returns.'
+        wallet_info += '\n' + f'Covariance model: {self.covariance_model}' + \
+                       (f' with {self.n_factors} factors' if self.covariance_model == 'factor' else '')
+        wallet_info += '\n' + f'Portfolio constraints: {self.constraints()}'
         return wallet_info
 
 
 class Interface():
     def __init__(self, args):
         self.file_mode_on = False
+        self.panel_dtype = 'float32' if args.float32 else 'float64'
+        self.portfolio_optimizer = ConstrainedOptimizer()
         if args.file:
             self.file_mode_on = True
             self.file_name = args.file
+            self.file_columns = args.columns.split(',') if args.columns else None
         if self.file_mode_on:
             log.info(f'File mode turned on, loading data from {self.file_name}')
             self.load_stocks_info_from_file()
             self.wallet_menu_file_mode()
         else:
+            self.data_provider = YahooProvider(args.requests_per_second)
+            self.price_cache = PriceHistoryCache(args.cache_dir or DEFAULT_CACHE_DIR)
+            self.price_cache.evict()
             self.main_menu()
             self.wallet_menu_api()
 
     def load_stocks_info_from_file(self):
         self.wallet = Wallet()
         self.wallet.file_mode_on = True
+        self.wallet.panel_dtype = self.panel_dtype
 
-        wallet_data = pd.read_csv(self.file_name, header=0, sep=';')
-        column_contains_only_numeric_data = wallet_data.apply(\
-            lambda s: pd.to_numeric(s, errors='coerce').notnull().all()).tolist()
-        if not all(numeric_column is True for numeric_column in column_contains_only_numeric_data):
-            log.error('Columns, apart from header, must contain only numeric values!')
+        try:
+            with span('fetch', source='file'):
+                symbols, prices = load_price_file(self.file_name, columns=self.file_columns, dtype=self.panel_dtype)
+        except ValueError as e:
+            log.error(str(e))
             exit(1)
 
-        for stock_name in wallet_data.columns:
-            self.wallet.stocks.append(Stock(stock_name, wallet_data[stock_name]))
-        self.wallet.time_horizon_in_days = len(self.wallet.stocks[0].pricing_info)
+        self.wallet.file_prices = PricePanel.from_prices(symbols, prices, dtype=self.panel_dtype)
+        self.wallet.stocks = [Stock(symbol) for symbol in symbols]
+        self.wallet.time_horizon_in_days = len(self.wallet.file_prices)
 
     def open_existing_wallet(self):
         while(True):
             wallet_path = input('Write path to file: ')
             if path.exists(wallet_path):
                 try:
-                    with open(wallet_path, 'rb') as wallet_pickle:
-                        self.wallet = pkl.load(wallet_pickle)
-                        if self.wallet.file_mode_on:
-                            self.file_mode_on = True
-                            log.info('Mode changed from API to file-mode')
-                        log.info('Wallet loaded successfully.')
-                        break
+                    try:
+                        self.wallet = load_wallet(wallet_path)
+                    except WalletFormatError:
+                        choice = input('This file looks like a wallet saved by an older version. Loading it runs ' \
+                                       'code stored in the file, do it only if you trust it. Load it? [y/n] ')
+                        if str.upper(choice) != 'Y':
+                            continue
+                        self.wallet = load_legacy_wallet(wallet_path)
+                        log.info('Save the wallet again to convert it to the current format.')
+                    if self.wallet.file_mode_on:
+                        self.file_mode_on = True
+                        log.info('Mode changed from API to file-mode')
+                    log.info('Wallet loaded successfully.')
+                    break
                 except Exception as e:
                     log.error(f'Cannot load wallet file! Reason: {e}')
             else:
@@ -111,23 +158,33 @@ class Interface():
                 elif str.upper(choice) == 'N':
                     continue
             try:
-                with open(wallet_path, 'wb') as wallet_pickle:
-                    pkl.dump(self.wallet, wallet_pickle)
+                save_wallet(self.wallet, wallet_path)
                 log.info(f'Walled successfully saved to {wallet_path}')
                 break
             except Exception as e:
                 log.error(f'Cannot save wallet file! Reason: {e}')
 
     def add_stock_to_wallet(self):
-        stock_to_add = input('Write symbol of stock you want to add: ')
-        try:
-            # threshold to pass
-            log.info('Checking if stock exist/is valid...')
-            yf.Ticker(stock_to_add).info
-            self.wallet.stocks.append(yf.Ticker(stock_to_add))
-            log.info(f'{stock_to_add} added successfully')
-        except Exception as e:
-            log.error(f'Cannot add stock named {stock_to_add}! Probably it does not exist in Yahoo Finance API.')
+        stocks_to_add = input('Write symbols of stocks you want to add (separated with commas) ' \
+                              'or path to file with one symbol per line: ').strip()
+        if path.isfile(stocks_to_add):
+            with open(stocks_to_add) as symbols_file:
+                symbols = [line.strip() for line in symbols_file]
+        else:
+            symbols = stocks_to_add.split(',')
+        stocks_names = [stock.info['symbol'] for stock in self.wallet.stocks]
+        symbols = [symbol.strip() for symbol in symbols if symbol.strip() and symbol.strip() not in stocks_names]
+
+        log.info(f'Checking if {len(symbols)} stock(s) exist/are valid...')
+        infos, failures = fetch_concurrently(self.data_provider.info, symbols)
+        for symbol in symbols:
+            if symbol in infos:
+                self.wallet.stocks.append(ApiStock(infos[symbol]))
+        if infos:
+            self.wallet.stages.invalidate('prices')
+            log.info(f'{", ".join(infos)} added successfully')
+        for symbol in failures:
+            log.error(f'Cannot add stock named {symbol}! Probably it does not exist in Yahoo Finance API.')
 
     def remove_stock_from_wallet(self):
         stock_to_remove = input('Write symbol of stock you want to remove: ')
@@ -136,6 +193,7 @@ class Interface():
             log.error('This stock does not exist in this wallet!')
         try:
             self.wallet.stocks = [stock for stock in self.wallet.stocks if stock.info['symbol'] != stock_to_remove]
+            self.wallet.stages.invalidate('prices')
             log.info('Stocks updated successfully')
         except Exception as e:
             log.error(f'Cannot remove stock named {stock_to_remove}! Reason: {e}')
@@ -145,6 +203,8 @@ class Interface():
             try:
                 self.wallet.k_risk_factor = float(input('Enter your risk factor k: '))
                 if self.wallet.k_risk_factor > 0:
+                    self.wallet.stages.invalidate('optimal')
+                    self.wallet.stages.invalidate('constrained')
                     log.info('Risk factor updated successfully.')
                     break
                 else:
@@ -159,6 +219,8 @@ class Interface():
                 self.wallet.risk_free_asset_expected_return = float(input('Enter your risk free ' \
                     'asset years\' expected return in percents: ')) / 100
                 if (self.wallet.risk_free_asset_expected_return >= 0) and (self.wallet.risk_free_asset_expected_return < 100):
+                    self.wallet.stages.invalidate('tangent')
+                    self.wallet.stages.invalidate('constrained')
                     log.info('Risk free asset updated successfully.')
                     break
                 else:
@@ -171,7 +233,8 @@ class Interface():
             try:
                 self.wallet.time_horizon_in_days = int(input('Enter amount of days to take data from: '))
                 if self.wallet.time_horizon_in_days > 0 and \
-                   given_data_is_long_enough(self.wallet.time_horizon_in_days, self.wallet.stocks, self.file_mode_on):
+                   given_data_is_long_enough(self.wallet.time_horizon_in_days, self.wallet.file_prices, self.file_mode_on):
+                    self.wallet.stages.invalidate('prices')
                     log.info('Time horizon updated successfully.')
                     break
                 else:
@@ -185,10 +248,11 @@ class Interface():
                 self.wallet.n_days_return_str = str(input('You want to calculate portfolio for n-days return. '\
                                                           'Enter interval (possible choices: 1d, 1wk, 1mo, 3mo): '))
                 if self.wallet.n_days_return_str in N_DAYS_RETURNS_MAP.keys() and \
-                   given_data_is_long_enough(self.wallet.time_horizon_in_days, self.wallet.stocks, self.file_mode_on) and \
+                   given_data_is_long_enough(self.wallet.time_horizon_in_days, self.wallet.file_prices, self.file_mode_on) and \
                    self.wallet.time_horizon_in_days >= N_DAYS_RETURNS_MAP[self.wallet.n_days_return_str]:
                     self.wallet.n_days_return = N_DAYS_RETURNS_MAP[self.wallet.n_days_return_str]
                     self.wallet.n_days_return_as_a_years_part = self.wallet.n_days_return / 365
+                    # every stage after prices is kept per interval, nothing to invalidate
                     log.info('Time horizon updated successfully.')
                     break
                 else:
@@ -201,6 +265,7 @@ class Interface():
             try:
                 self.wallet.budget = int(input('Enter your budget: '))
                 if self.wallet.budget > 0:
+                    self.wallet.stages.invalidate('allocation')
                     log.info('Budget updated successfully.')
                     break
                 else:
@@ -208,79 +273,168 @@ class Interface():
             except:
                 log.error('You entered wrong number, try again.')
 
+    def update_covariance_model(self):
+        while True:
+            covariance_model = input(f'Enter covariance model (possible choices: {", ".join(COVARIANCE_MODELS)}): ')
+            if covariance_model not in COVARIANCE_MODELS:
+                log.error('Value is not valid, try again.')
+                continue
+            if covariance_model == 'factor':
+                try:
+                    n_factors = int(input('Enter amount of factors: '))
+                    if n_factors <= 0:
+                        raise ValueError
+                except ValueError:
+                    log.error('You entered wrong number (value must be greater than zero), try again.')
+                    continue
+                self.wallet.n_factors = n_factors
+            self.wallet.covariance_model = covariance_model
+            self.wallet.stages.invalidate('cov')
+            log.info('Covariance model updated successfully.')
+            break
+
+    def update_portfolio_constraints(self):
+        try:
+            long_only = input('Forbid short positions? [y/n] ')
+            max_asset_weight = input('Enter maximal weight of one stock in percents of budget (empty for no limit): ')
+            max_leverage = input('Enter maximal sum of absolute stocks\' weights in percents of budget '
+                                 '(100 means no borrowing, empty for no limit): ')
+            max_asset_weight = float(max_asset_weight) / 100 if max_asset_weight.strip() else None
+            max_leverage = float(max_leverage) / 100 if max_leverage.strip() else None
+            if str.upper(long_only) not in ['Y', 'N'] or (max_asset_weight is not None and max_asset_weight <= 0) or \
+               (max_leverage is not None and max_leverage <= 0):
+                raise ValueError
+        except ValueError:
+            log.error('You entered wrong value, try again.')
+            return
+        self.wallet.long_only = str.upper(long_only) == 'Y'
+        self.wallet.max_asset_weight = max_asset_weight
+        self.wallet.max_leverage = max_leverage
+        self.wallet.stages.invalidate('constrained')
+        log.info(f'Portfolio constraints updated successfully: {self.wallet.constraints()}.')
+
+    def horizon_rows(self, price_panel, days):
+        """Rows of a daily panel in the last `days` days, rows are days in file mode"""
+        if self.file_mode_on:
+            return slice(max(len(price_panel) - days, 0), None)
+        return slice(price_panel.index.searchsorted(pd.Timestamp.today().normalize() - pd.Timedelta(days=days)), None)
+
+    def get_price_panel(self, days=None):
+        """Daily prices, other intervals are derived from them"""
+        days = days or self.wallet.time_horizon_in_days
+        if self.file_mode_on:
+            return self.wallet.file_prices.subset(rows=self.horizon_rows(self.wallet.file_prices, days))
+        return panel_from_cache(self.price_cache, self.data_provider,
+                                [stock.info['symbol'] for stock in self.wallet.stocks],
+                                '1d', days, dtype=self.wallet.panel_dtype)
+
+    def fetch_wallet_prices(self):
+        self.wallet.prices_fetched_at = time.time()
+        return self.get_price_panel()
+
     def get_stocks_returns(self):
-        self.wallet.stocks_returns = pd.DataFrame()
-        for stock in self.wallet.stocks:
-            if self.file_mode_on:
-                stock_info = stock.pricing_info
-            else:
-                stock_info = \
-                    yf.Ticker(stock.info['symbol'])\
-                    .history(period=f'{self.wallet.time_horizon_in_days}d', interval=self.wallet.n_days_return_str)\
-                    [['Close', 'Dividends', 'Stock Splits']]
-            stock_info['Adj Close'] = stock_info['Close'] - stock_info['Dividends']
-            stock_info['Adj Close'] = \
-                stock_info.apply(lambda x: apply_stock_splits(x['Adj Close'], x['Stock Splits']), axis=1)
-            try:
-                self.wallet.stocks_returns[stock.info['symbol']] = \
-                    stock_info['Adj Close'].dropna().pct_change()*100
-            except ValueError:
-                self.wallet.stocks_returns[stock.info['symbol']] = \
-                    (stock_info['Adj Close'].pct_change()*100).reindex(self.wallet.stocks_returns.index)
+        self.wallet.price_panel = self.wallet.stages.get('prices', self.fetch_wallet_prices)
+        self.wallet.returns_panel = self.wallet.stages.get(
+            'returns', lambda: self.wallet.price_panel.resample(self.wallet.n_days_return_str, self.wallet.n_days_return),
+            key=self.wallet.n_days_return_str)
+        self.wallet.stocks_returns = self.wallet.returns_panel.returns_frame()
+
+    def get_returns_statistics(self):
+        interval = self.wallet.n_days_return_str
+        self.wallet.mean_returns = self.wallet.stages.get('mean', self.wallet.returns_panel.mean_returns, key=interval)
+        self.wallet.cov_matrix = self.wallet.stages.get('cov', lambda: estimate_covariance(
+            self.wallet.returns_panel, self.wallet.covariance_model, self.wallet.n_factors), key=interval)
+
+    def get_covariance_solver(self):
+        return self.wallet.stages.get('factorization', lambda: covariance_solver(self.wallet.cov_matrix),
+                                      key=self.wallet.n_days_return_str)
 
     def calculate_z_matrix(self):
         avg_returns_matrix = \
-            (self.wallet.stocks_returns.mean() - \
-             self.wallet.risk_free_asset_expected_return_in_given_time_horizon).\
-             to_numpy()[np.newaxis].T
-        self.wallet.cov_matrix = self.wallet.stocks_returns.cov().to_numpy()
-        z_matrix = np.dot(np.linalg.inv(self.wallet.cov_matrix), avg_returns_matrix)
+            (self.wallet.mean_returns - self.wallet.risk_free_asset_expected_return_in_given_time_horizon)[np.newaxis].T
+        z_matrix = self.get_covariance_solver().solve(avg_returns_matrix)
         return z_matrix
 
+    def compute_tangent_portfolio_weights(self):
+        z_vector = self.calculate_z_matrix().ravel()
+        return z_vector / z_vector.sum()
+
     def calculate_tangent_portfolio_weights(self):
         self.get_stocks_returns()
+        self.get_returns_statistics()
         log.info('Returns calculated, now calculating tangent portfolio weights..')
-        list_of_z = [item for sublist in self.calculate_z_matrix().tolist() for item in sublist]
-        self.wallet.risk_assets_weights = [z / sum(list_of_z) for z in list_of_z]
+        self.wallet.risk_assets_weights = self.wallet.stages.get('tangent', self.compute_tangent_portfolio_weights,
+                                                                  key=self.wallet.n_days_return_str)
         log.info('Tangent portfolio weights calculated, now calculating optimal portfolio weights..')
 
     def calculate_tangent_portfolio_std_dev(self):
-        tangent_portfolio_variation = 0
-        for i, risk_assets_weight_i in enumerate(self.wallet.risk_assets_weights):
-            for j, risk_assets_weight_j in enumerate(self.wallet.risk_assets_weights):
-                tangent_portfolio_variation += risk_assets_weight_i * risk_assets_weight_j * self.wallet.cov_matrix[i][j]
+        return sqrt(self.get_covariance_solver().variance(self.wallet.risk_assets_weights))
 
-        return sqrt(abs(tangent_portfolio_variation))
+    def compute_tangent_portfolio_parameters(self):
+        tangent_portfolio_std_dev = self.calculate_tangent_portfolio_std_dev()
+        tangent_portfolio_expected_return = float(self.wallet.risk_assets_weights @ self.wallet.mean_returns)
+        return tangent_portfolio_std_dev, tangent_portfolio_expected_return
 
     def get_tangent_portfolio_parameters(self):
-        self.wallet.tangent_portfolio_std_dev = self.calculate_tangent_portfolio_std_dev()
-        avg_returns_list = self.wallet.stocks_returns.mean().tolist()
-        self.wallet.tangent_portfolio_expected_return = sum([y * mu for y, mu in zip(self.wallet.risk_assets_weights, avg_returns_list)])
+        self.wallet.tangent_portfolio_std_dev, self.wallet.tangent_portfolio_expected_return = \
+            self.wallet.stages.get('tangent_parameters', self.compute_tangent_portfolio_parameters,
+                                   key=self.wallet.n_days_return_str)
 
     def get_optimal_portfolio_parameters(self):
-        self.wallet.optimal_portfolio_A = (self.wallet.tangent_portfolio_std_dev ** 2) / \
-            ((self.wallet.risk_free_asset_expected_return_in_given_time_horizon - self.wallet.tangent_portfolio_expected_return) ** 2)
-        self.wallet.optimal_portfolio_std_dev = sqrt(1 / (4 * (self.wallet.k_risk_factor ** 2) * self.wallet.optimal_portfolio_A))
-        self.wallet.optimal_portfolio_expected_return = self.wallet.risk_free_asset_expected_return_in_given_time_horizon + \
-            (1 / (2 * self.wallet.k_risk_factor * self.wallet.optimal_portfolio_A))
+        return tuple(float(parameter) for parameter in optimal_portfolio_parameters(
+            self.wallet.tangent_portfolio_expected_return, self.wallet.tangent_portfolio_std_dev,
+            self.wallet.risk_free_asset_expected_return_in_given_time_horizon, self.wallet.k_risk_factor))
 
     def calculate_optimal_portfolio_weights(self):
         self.get_tangent_portfolio_parameters()
-        self.get_optimal_portfolio_parameters()
-        self.wallet.risk_free_asset_weight = \
-            (self.wallet.optimal_portfolio_expected_return - self.wallet.tangent_portfolio_expected_return) / \
-            (self.wallet.risk_free_asset_expected_return_in_given_time_horizon - self.wallet.tangent_portfolio_expected_return)
+        self.wallet.optimal_portfolio_A, self.wallet.optimal_portfolio_std_dev, \
+            self.wallet.optimal_portfolio_expected_return, self.wallet.risk_free_asset_weight = \
+            self.wallet.stages.get('optimal', self.get_optimal_portfolio_parameters, key=self.wallet.n_days_return_str)
         self.wallet.optimal_portfolio_risk_assets_weight = 1 - self.wallet.risk_free_asset_weight
 
-    def show_budget_calculations(self):
-        log.info('That means, that you should invest your money this way in risk assets:')
+    def calculate_constrained_portfolio_weights(self):
+        self.get_stocks_returns()
+        self.get_returns_statistics()
+        log.info(f'Returns calculated, now calculating {self.wallet.constraints()} portfolio weights..')
+        risk_free_return = self.wallet.risk_free_asset_expected_return_in_given_time_horizon
+        weights = self.wallet.stages.get('constrained', lambda: self.portfolio_optimizer.solve(
+            self.wallet.mean_returns, self.get_covariance_solver(), risk_free_return, self.wallet.k_risk_factor,
+            self.wallet.constraints())[0], key=self.wallet.n_days_return_str)
+        self.wallet.risk_assets_weights, self.wallet.tangent_portfolio_expected_return, \
+            self.wallet.tangent_portfolio_std_dev, self.wallet.optimal_portfolio_expected_return, \
+            self.wallet.optimal_portfolio_std_dev, self.wallet.risk_free_asset_weight = \
+            [float(parameter) if np.ndim(parameter) == 0 else parameter for parameter in
+             constrained_portfolio_parameters(weights, self.wallet.mean_returns, self.get_covariance_solver(),
+                                              risk_free_return)]
+        self.wallet.optimal_portfolio_risk_assets_weight = 1 - self.wallet.risk_free_asset_weight
+
+    def calculate_portfolio(self):
+        """Closed-form optimal portfolio, or the constrained one when the wallet has constraints"""
+        self.wallet.risk_free_asset_expected_return_in_given_time_horizon = \
+            self.wallet.risk_free_asset_expected_return * self.wallet.n_days_return_as_a_years_part
+        if self.wallet.constraints().active:
+            self.calculate_constrained_portfolio_weights()
+        else:
+            self.calculate_tangent_portfolio_weights()
+            self.calculate_optimal_portfolio_weights()
+
+    def compute_budget_allocation(self):
         risk_assets_investments = [i * self.wallet.optimal_portfolio_risk_assets_weight * self.wallet.budget for i in self.wallet.risk_assets_weights]
         risk_free_asset_investment = self.wallet.risk_free_asset_weight * self.wallet.budget
+        return risk_assets_investments, risk_free_asset_investment
+
+    def show_budget_calculations(self):
+        log.info('That means, that you should invest your money this way in risk assets:')
+        risk_assets_investments, risk_free_asset_investment = \
+            self.wallet.stages.get('allocation', self.compute_budget_allocation, key=self.wallet.n_days_return_str)
         for risk_asset_investment, stock in zip(risk_assets_investments, self.wallet.stocks):
             stock_name = stock.info['shortName']
             log.info(f'{stock_name} - {risk_asset_investment:.2f} USD')
         log.info(f'In risk free asset, you shold invest {risk_free_asset_investment:.2f} USD')
-        log.info('Remember, if any invesment retuns negative score - you should make it short position.')
+        if self.wallet.constraints().active:
+            log.info(f'Portfolio is constrained: {self.wallet.constraints()}.')
+        else:
+            log.info('Remember, if any invesment retuns negative score - you should make it short position.')
 
     def show_risk_assets_weights(self):
         log.info('Risk assests weights:')
@@ -290,15 +444,16 @@ class Interface():
 
     def show_covariation_matrix(self):
         log.info('Covariation matrix:')
-        print(self.wallet.cov_matrix)
+        print(summarize_covariance(self.wallet.cov_matrix))
 
     def show_optimal_portfolio_weights(self):
-        self.wallet.risk_free_asset_expected_return_in_given_time_horizon = \
-            self.wallet.risk_free_asset_expected_return * self.wallet.n_days_return_as_a_years_part
-        self.calculate_tangent_portfolio_weights()
+        try:
+            self.calculate_portfolio()
+        except (DataFetchError, CovarianceError, ValueError) as e:
+            log.error(f'Cannot calculate portfolio! Reason: {e}')
+            return
         self.show_risk_assets_weights()
         self.show_covariation_matrix()
-        self.calculate_optimal_portfolio_weights()
         log.debug(f'Risk assets exp ret: {self.wallet.tangent_portfolio_expected_return}')
         log.debug(f'Risk assets std dev: {self.wallet.tangent_portfolio_std_dev}')
         log.debug(f'Risk free assets exp ret: {self.wallet.risk_free_asset_expected_return_in_given_time_horizon}')
@@ -306,6 +461,117 @@ class Interface():
         log.info(f'Risk free asset weight is {self.wallet.risk_free_asset_weight:.2f}')
         self.show_budget_calculations()
 
+    def export_portfolio_sweep(self):
+        try:
+            k_risk_factors = parse_grid(input('Enter risk factors k to sweep (start,stop,count): '))
+            risk_free_returns = parse_grid(input('Enter risk free asset years\' expected returns in percents ' \
+                                                 'to sweep (start,stop,count): ')) / 100
+        except ValueError:
+            log.error('You entered wrong values, expected e.g. 1,10,100.')
+            return
+        if (k_risk_factors <= 0).any():
+            log.error('Risk factors must be greater than zero!')
+            return
+        sweep_path = input('Write path to CSV file where you want to save the sweep: ')
+        try:
+            self.get_stocks_returns()
+            self.get_returns_statistics()
+            sweep_table = sweep_portfolios(self.wallet.mean_returns, self.get_covariance_solver(),
+                                           k_risk_factors, risk_free_returns,
+                                           symbols=[stock.info['symbol'] for stock in self.wallet.stocks],
+                                           years_part_of_return=self.wallet.n_days_return_as_a_years_part,
+                                           constraints=self.wallet.constraints(), optimizer=self.portfolio_optimizer)
+            export_sweep(sweep_table, sweep_path)
+            log.info(f'Sweep of {len(sweep_table)} portfolios saved to {sweep_path}')
+        except (DataFetchError, CovarianceError) as e:
+            log.error(f'Cannot calculate portfolios! Reason: {e}')
+        except OSError as e:
+            log.error(f'Cannot save sweep file! Reason: {e}')
+
+    def backtest_periods(self, price_panel):
+        """(returns in the optimisation window, returns available) of the wallet's interval over a daily panel,
+        the window covers the wallet's amount of days sliced on dates as the optimisation does"""
+        window_panel = price_panel.subset(rows=self.horizon_rows(price_panel, self.wallet.time_horizon_in_days))
+        window = len(window_panel.resample(self.wallet.n_days_return_str, self.wallet.n_days_return)) - 1
+        periods = len(price_panel.resample(self.wallet.n_days_return_str, self.wallet.n_days_return)) - 1
+        return window, periods
+
+    def run_backtest(self):
+        if self.file_mode_on:
+            window, periods = self.backtest_periods(self.wallet.file_prices)
+            if periods <= window:
+                max_days = len(self.wallet.file_prices) - self.wallet.n_days_return
+                log.error(f'Amount of days to take data from ({self.wallet.time_horizon_in_days}) leaves no periods '
+                          f'to backtest over, set it to at most {max_days} days!')
+                return
+        try:
+            rebalance_every = int(input('Rebalance every how many periods: '))
+            if rebalance_every <= 0:
+                raise ValueError
+            history_days = len(self.wallet.file_prices) if self.file_mode_on else None
+            if not self.file_mode_on:
+                min_days = self.wallet.time_horizon_in_days + self.wallet.n_days_return
+                history_days = int(input(f'Enter amount of days of history to backtest over (more than {min_days}): '))
+                if history_days <= min_days:
+                    log.error(f'History must be longer than {min_days} days!')
+                    return
+        except ValueError:
+            log.error('You entered wrong number, try again.')
+            return
+        risk_free_return = self.wallet.risk_free_asset_expected_return * self.wallet.n_days_return_as_a_years_part
+        weights_solver = None
+        if self.wallet.constraints().active:
+            weights_solver = self.portfolio_optimizer.weights_solver(risk_free_return, self.wallet.k_risk_factor,
+                                                                     self.wallet.constraints())
+        try:
+            daily_panel = self.get_price_panel(history_days)
+            window, periods = self.backtest_periods(daily_panel)
+            if periods <= window:
+                log.error(f'History of {history_days} days has {periods} {self.wallet.n_days_return_str} periods, '
+                          f'the {self.wallet.time_horizon_in_days}-day window alone takes {window}. Enter a longer '
+                          'history!')
+                return
+            price_panel = daily_panel.resample(self.wallet.n_days_return_str, self.wallet.n_days_return)
+            backtest_result = backtest_panel(price_panel, window, rebalance_every, risk_free_return,
+                                             self.wallet.k_risk_factor, weights_solver=weights_solver,
+                                             covariance_model=self.wallet.covariance_model,
+                                             n_factors=self.wallet.n_factors)
+        except (DataFetchError, CovarianceError, ValueError) as e:
+            log.error(f'Cannot run backtest! Reason: {e}')
+            return
+        log.info(f'Backtest of {window}-period ({self.wallet.time_horizon_in_days} days) window rebalanced every '
+                 f'{rebalance_every} periods:')
+        for name, value in backtest_result.summary().items():
+            log.info(f'{name} - {value:.2f}')
+
+    def simulate_portfolio_outcomes(self):
+        try:
+            periods = int(input(f'Enter amount of {self.wallet.n_days_return_str} periods to simulate: '))
+            loss = float(input('Enter loss in USD to calculate the chance of: '))
+            if periods <= 0 or loss < 0:
+                raise ValueError
+        except ValueError:
+            log.error('You entered wrong number, try again.')
+            return
+        try:
+            self.calculate_portfolio()
+        except (DataFetchError, CovarianceError, ValueError) as e:
+            log.error(f'Cannot calculate portfolio! Reason: {e}')
+            return
+        risk_assets_investments, risk_free_asset_investment = \
+            self.wallet.stages.get('allocation', self.compute_budget_allocation, key=self.wallet.n_days_return_str)
+        simulation_result = simulate_portfolio(self.wallet.mean_returns, self.wallet.cov_matrix,
+                                               risk_assets_investments, risk_free_asset_investment,
+                                               self.wallet.risk_free_asset_expected_return_in_given_time_horizon,
+                                               periods=periods)
+        log.info(f'Final value of {self.wallet.budget} USD after {periods} periods, '
+                 f'{len(simulation_result.final_values)} simulated paths:')
+        print(simulation_result.percentiles().to_string(index=False, float_format='{:.2f}'.format))
+        for confidence in [0.95, 0.99]:
+            log.info(f'VaR {confidence:.0%} - {simulation_result.value_at_risk(confidence):.2f} USD, '
+                     f'CVaR {confidence:.0%} - {simulation_result.conditional_value_at_risk(confidence):.2f} USD')
+        log.info(f'Chance of losing more than {loss:.2f} USD is {simulation_result.probability_of_loss(loss):.2%}')
+
     def main_menu(self):
         log.info('Welcome to the-wallet - Markowitz Portfolio tool')
 
@@ -325,6 +591,7 @@ class Interface():
                 break
             elif selection == '2':
                 self.wallet = Wallet()
+                self.wallet.panel_dtype = self.panel_dtype
                 log.info('New wallet created.')
                 break
             elif selection == '3':
@@ -345,7 +612,12 @@ class Interface():
         wallet_menu['7'] = 'Update budget'
         wallet_menu['8'] = 'Show optimal portfolio weights'
         wallet_menu['9'] = 'Save wallet to file'
-        wallet_menu['10'] = 'Exit'
+        wallet_menu['10'] = 'Export risk factor/risk-free rate sweep to CSV'
+        wallet_menu['11'] = 'Run rolling-window backtest'
+        wallet_menu['12'] = 'Update covariance model'
+        wallet_menu['13'] = 'Simulate portfolio outcomes'
+        wallet_menu['14'] = 'Update portfolio constraints'
+        wallet_menu['15'] = 'Exit'
 
         while(True):
             print()
@@ -375,6 +647,16 @@ class Interface():
             elif selection == '9':
                 self.save_wallet_to_file()
             elif selection == '10':
+                self.export_portfolio_sweep()
+            elif selection == '11':
+                self.run_backtest()
+            elif selection == '12':
+                self.update_covariance_model()
+            elif selection == '13':
+                self.simulate_portfolio_outcomes()
+            elif selection == '14':
+                self.update_portfolio_constraints()
+            elif selection == '15':
                 self.main_menu()
             else:
                 log.error('Unknown Option Selected!')
@@ -389,7 +671,12 @@ class Interface():
         wallet_menu['5'] = 'Update budget'
         wallet_menu['6'] = 'Show optimal portfolio weights'
         wallet_menu['7'] = 'Save wallet to file'
-        wallet_menu['8'] = 'Exit'
+        wallet_menu['8'] = 'Export risk factor/risk-free rate sweep to CSV'
+        wallet_menu['9'] = 'Run rolling-window backtest'
+        wallet_menu['10'] = 'Update covariance model'
+        wallet_menu['11'] = 'Simulate portfolio outcomes'
+        wallet_menu['12'] = 'Update portfolio constraints'
+        wallet_menu['13'] = 'Exit'
 
         while(True):
             print()
@@ -415,6 +702,16 @@ class Interface():
             elif selection == '7':
                 self.save_wallet_to_file()
             elif selection == '8':
+                self.export_portfolio_sweep()
+            elif selection == '9':
+                self.run_backtest()
+            elif selection == '10':
+                self.update_covariance_model()
+            elif selection == '11':
+                self.simulate_portfolio_outcomes()
+            elif selection == '12':
+                self.update_portfolio_constraints()
+            elif selection == '13':
                 exit(0)
             else:
                 log.error('Unknown Option Selected!')
@@ -0,0 +1,223 @@
+import contextvars
+import tracemalloc
+import threading
+import json
+import time
+import os
+
+COUNTERS = ['bytes_fetched', 'cache_hits', 'cache_misses']
+PROMETHEUS_PREFIX = 'the_wallet'
+
+_hooks = []
+# spans open in the current thread or asyncio task, counters go to these
+_open_spans = contextvars.ContextVar('open_spans', default=())
+# spans open in the whole process, tracemalloc peak is process-wide
+_all_open_spans = set()
+_lock = threading.Lock()
+_trace_memory = False
+
+
+class Span():
+    """Wall time, CPU time, peak of allocations and counters of one stage, nested spans count into their parents"""
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.wall_seconds = self.cpu_seconds = 0
+        self.peak_bytes = None
+        self.max_traced_bytes = 0
+        self.concurrent = False
+        self.error = None
+
+    def __enter__(self):
+        own_spans = _open_spans.get()
+        with _lock:
+            concurrent_spans = _all_open_spans.difference(own_spans)
+            if concurrent_spans:
+                # spans of other threads or tasks run meanwhile, process-wide peak and CPU time are not theirs alone
+                self.concurrent = True
+                for concurrent_span in concurrent_spans:
+                    concurrent_span.concurrent = True
+            if _trace_memory:
+                _fold_peak()
+                self.start_traced_bytes = self.max_traced_bytes = tracemalloc.get_traced_memory()[0]
+            _all_open_spans.add(self)
+        self.token = _open_spans.set(own_spans + (self,))
+        self.started_at = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start, self.thread_cpu_start = time.process_time(), time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_seconds = time.perf_counter() - self.wall_start
+        self.error = exc_type.__name__ if exc_type else None
+        _open_spans.reset(self.token)
+        with _lock:
+            if self.concurrent:
+                # CPU time of this thread only, peak is left out
+                self.cpu_seconds = time.thread_time() - self.thread_cpu_start
+            else:
+                # CPU time of this process, threads working for the span (e.g. fetch) included
+                self.cpu_seconds = time.process_time() - self.cpu_start
+            if _trace_memory:
+                _fold_peak()
+                if not self.concurrent:
+                    self.peak_bytes = self.max_traced_bytes - self.start_traced_bytes
+            _all_open_spans.discard(self)
+        for hook in list(_hooks):
+            hook(self)
+
+    def as_dict(self):
+        return {'stage': self.stage, 'started_at': self.started_at, 'wall_seconds': self.wall_seconds,
+                'cpu_seconds': self.cpu_seconds, 'peak_bytes': self.peak_bytes, **self.counters,
+                'error': self.error, **self.attributes}
+
+    @classmethod
+    def from_dict(cls, record):
+        """Finished span back from `as_dict`, e.g. one recorded in another process"""
+        record = dict(record)
+        finished_span = cls(record.pop('stage'), {})
+        finished_span.started_at = record.pop('started_at')
+        finished_span.wall_seconds = record.pop('wall_seconds')
+        finished_span.cpu_seconds = record.pop('cpu_seconds')
+        finished_span.peak_bytes = record.pop('peak_bytes')
+        finished_span.error = record.pop('error')
+        finished_span.counters = {counter: record.pop(counter) for counter in COUNTERS}
+        finished_span.attributes = record
+        return finished_span
+
+
+class NoSpan():
+    """Shared do-nothing span returned while instrumentation is disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+def _fold_peak():
+    """Peak since the last fold goes to every open span, then the peak is reset for the next interval"""
+    peak = tracemalloc.get_traced_memory()[1]
+    for open_span in _all_open_spans:
+        open_span.max_traced_bytes = max(open_span.max_traced_bytes, peak)
+    tracemalloc.reset_peak()
+
+
+def span(stage, **attributes):
+    """`with span('covariance', key='1d'):` times the block when a hook is registered, costs nothing otherwise"""
+    if not _hooks:
+        return NO_SPAN
+    return Span(stage, attributes)
+
+
+def count(counter, amount=1):
+    """Adds to a counter of every span open in this thread or task, e.g. count('cache_hits')"""
+    open_spans = _open_spans.get()
+    if not open_spans:
+        return
+    with _lock:
+        for open_span in open_spans:
+            open_span.counters[counter] += amount
+
+
+def add_hook(hook, trace_memory=True):
+    """Registers `hook(span)` called whenever a span ends, peak allocations are traced when `trace_memory`"""
+    global _trace_memory
+    _hooks.append(hook)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _trace_memory = _trace_memory or trace_memory
+
+
+def enabled():
+    return bool(_hooks)
+
+
+def traces_memory():
+    return _trace_memory
+
+
+def remove_hooks():
+    global _trace_memory
+    _hooks.clear()
+    if _trace_memory:
+        tracemalloc.stop()
+        _trace_memory = False
+
+
+class JsonLinesExporter():
+    """Appends every finished span as one JSON line"""
+    def __init__(self, file_name):
+        self.file = open(file_name, 'a')
+        self.lock = threading.Lock()
+
+    def __call__(self, finished_span):
+        with self.lock:
+            self.file.write(json.dumps(finished_span.as_dict()) + '\n')
+            self.file.flush()
+
+
+class PrometheusExporter():
+    """Totals per stage in Prometheus text format, rewritten after every span (for node exporter's textfile collector)"""
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, finished_span):
+        with self.lock:
+            totals = self.totals.setdefault(finished_span.stage, dict.fromkeys(
+                ['calls', 'wall_seconds', 'cpu_seconds', 'peak_bytes', 'errors'] + COUNTERS, 0))
+            totals['calls'] += 1
+            totals['errors'] += finished_span.error is not None
+            totals['wall_seconds'] += finished_span.wall_seconds
+            totals['cpu_seconds'] += finished_span.cpu_seconds
+            totals['peak_bytes'] = max(totals['peak_bytes'], finished_span.peak_bytes or 0)
+            for counter in COUNTERS:
+                totals[counter] += finished_span.counters[counter]
+            self.write()
+
+    def write(self):
+        lines = []
+        for name, metric_type in [('calls', 'counter'), ('errors', 'counter'), ('wall_seconds', 'counter'),
+                                  ('cpu_seconds', 'counter'), ('peak_bytes', 'gauge'), ('bytes_fetched', 'counter'),
+                                  ('cache_hits', 'counter'), ('cache_misses', 'counter')]:
+            metric = f'{PROMETHEUS_PREFIX}_stage_{name}' + ('_total' if metric_type == 'counter' else '')
+            lines.append(f'# TYPE {metric} {metric_type}')
+            lines += [f'{metric}{{stage="{stage}"}} {totals[name]}' for stage, totals in self.totals.items()]
+        tmp_path = self.file_name + '.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.file_name)
+
+
+class SpanRecorder():
+    """Keeps finished spans as dicts, worker processes send them to the parent to be emitted there"""
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, finished_span):
+        self.records.append(finished_span.as_dict())
+
+    def take(self):
+        records, self.records = self.records, []
+        return records
+
+
+def emit(records, **attributes):
+    """Passes spans recorded elsewhere to the hooks of this process, with extra attributes (e.g. wallet name)"""
+    for record in records:
+        finished_span = Span.from_dict({**record, **attributes})
+        for hook in list(_hooks):
+            hook(finished_span)
+
+
+EXPORTERS = {'jsonl': JsonLinesExporter, 'prometheus': PrometheusExporter}
+
+
+def enable(file_name, exporter='jsonl', trace_memory=True):
+    add_hook(EXPORTERS[exporter](file_name), trace_memory)
@@ -1,6 +1,9 @@
 import functions as func
+import instrumentation
 import argparse
 
+from providers import DEFAULT_REQUESTS_PER_SECOND
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='the-wallet - Markowitz Portfolio Tool to calculate ' \
@@ -10,6 +13,56 @@ if __name__ == '__main__':
                                                        'mode, more information (about file preparation ' \
                                                        'etc.) can be found in README.md')
 
+    parser.add_argument('--columns', type=str, help='Comma separated names of stocks to load from the file in ' \
+                                                     'file mode (default: all columns)')
+
+    parser.add_argument('--float32', action='store_true', help='Keep prices in single precision, halves memory ' \
+                                                               'of very wide or long datasets')
+
+    parser.add_argument('--cache-dir', type=str, help='Directory of the local price history cache used ' \
+                                                       'in API mode (default: .price_cache next to the app)')
+
+    parser.add_argument('--requests-per-second', type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+                        help='Limit of requests sent to Yahoo Finance in API mode ' \
+                             f'(default: {DEFAULT_REQUESTS_PER_SECOND}, 0 turns the limit off)')
+
+    parser.add_argument('--batch', type=str, help='Run without menus, evaluating every wallet from given JSON ' \
+                                                   'batch spec, more information can be found in README.md')
+
+    parser.add_argument('--output', type=str, default='batch_results', help='Directory where batch mode ' \
+                                                                            'writes results.json and allocations.csv')
+
+    parser.add_argument('--workers', type=int, help='Amount of worker processes in batch mode, or of solver ' \
+                                                     'threads in server mode (default: all cores)')
+
+    parser.add_argument('--serve', action='store_true', help='Run HTTP/JSON server answering portfolio requests ' \
+                                                              'from warm caches, more information in README.md')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address the server listens on')
+
+    parser.add_argument('--port', type=int, default=8765, help='Port the server listens on')
+
+    parser.add_argument('--metrics', type=str, help='Record time, CPU time, peak memory, fetched bytes and cache ' \
+                                                     'hits of every stage into given file (off by default)')
+
+    parser.add_argument('--metrics-format', type=str, default='jsonl', choices=list(instrumentation.EXPORTERS),
+                        help='One JSON line per stage, or Prometheus text format totals per stage')
+
+    parser.add_argument('--no-trace-memory', action='store_true', help='Do not trace peak memory of stages, ' \
+                                                                        'tracing slows allocations down')
+
     args = parser.parse_args()
 
-    func.Interface(args)
+    if args.metrics:
+        instrumentation.enable(args.metrics, args.metrics_format, trace_memory=not args.no_trace_memory)
+
+    if args.serve:
+        import server
+        server.run_server(args.host, args.port, args.cache_dir, 'float32' if args.float32 else 'float64', args.workers,
+                          args.requests_per_second)
+    elif args.batch:
+        import batch
+        batch.run_batch(args.batch, args.output, args.workers, args.cache_dir,
+                        'float32' if args.float32 else 'float64', args.requests_per_second)
+    else:
+        func.Interface(args)
@@ -0,0 +1,127 @@
+import pandas as pd
+import numpy as np
+
+from additional_functions import apply_stock_splits
+from instrumentation import span
+
+PRICE_COLUMNS = ['Close', 'Dividends', 'Stock Splits']
+# calendar periods of API intervals, data without dates are sampled every n rows instead
+RESAMPLE_RULES = {'1wk': 'W', '1mo': 'MS', '3mo': 'QS'}
+
+
+def normalize_history(history):
+    history = history[PRICE_COLUMNS]
+    if isinstance(history.index, pd.DatetimeIndex) and history.index.tz is not None:
+        # different exchanges report different timezones, align on calendar days
+        history = history.set_axis(history.index.tz_localize(None).normalize(), axis=0)
+    return history
+
+
+class PricePanel():
+    """Aligned dates x symbols close/dividend/split arrays of one wallet"""
+    def __init__(self, index, symbols, close, dividends=None, splits=None, dtype=np.float64):
+        self.index = index
+        self.symbols = list(symbols)
+        self.dtype = np.dtype(dtype)
+        self.close = np.ascontiguousarray(close, dtype=self.dtype)
+        # None means no dividends/splits (file mode), saves two panel-sized arrays
+        self.dividends = None if dividends is None else np.ascontiguousarray(dividends, dtype=self.dtype)
+        self.splits = None if splits is None else np.ascontiguousarray(splits, dtype=self.dtype)
+        self._adjusted_prices = None
+        self._returns = None
+        self._valid_lengths = None
+
+    @classmethod
+    def from_histories(cls, symbols, histories, dtype=np.float64):
+        """Aligns per-symbol Close/Dividends/Stock Splits frames with a single outer join on dates"""
+        symbols = list(symbols)
+        if not symbols:
+            return cls(pd.Index([]), [], np.empty((0, 0)), np.empty((0, 0)), np.empty((0, 0)), dtype)
+        histories = [normalize_history(history) for history in histories]
+        joined = pd.concat(histories, axis=1, keys=list(range(len(symbols))), join='outer', sort=True)
+        fields = [joined.xs(column, axis=1, level=1).to_numpy(dtype=dtype) for column in PRICE_COLUMNS]
+        return cls(joined.index, symbols, *fields, dtype=dtype)
+
+    @classmethod
+    def from_prices(cls, symbols, close_prices, index=None, dtype=np.float64):
+        """Panel of plain close prices, e.g. loaded in file mode"""
+        index = pd.RangeIndex(len(close_prices)) if index is None else index
+        return cls(index, symbols, close_prices, dtype=dtype)
+
+    def subset(self, symbols=None, rows=slice(None)):
+        """Panel of some stocks and/or a slice of rows, rows are views while columns are copied"""
+        def select(array):
+            if array is None:
+                return None
+            array = array[rows]
+            return array if columns is None else array[:, columns]
+        columns = None
+        if symbols is not None and list(symbols) != self.symbols:
+            positions = {symbol: position for position, symbol in enumerate(self.symbols)}
+            columns = [positions[symbol] for symbol in symbols]
+        return PricePanel(self.index[rows], self.symbols if symbols is None else symbols,
+                          select(self.close), select(self.dividends), select(self.splits), dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def shape(self):
+        return self.close.shape
+
+    def valid_lengths(self):
+        """Amount of prices each stock really has, gaps from the join excluded"""
+        if self._valid_lengths is None:
+            self._valid_lengths = (~np.isnan(self.close)).sum(axis=0)
+        return self._valid_lengths
+
+    def adjusted_prices(self):
+        if self._adjusted_prices is None:
+            with span('adjustment', stocks=len(self.symbols), rows=len(self)):
+                adjusted_prices = self.close if self.dividends is None else self.close - self.dividends
+                if self.splits is not None:
+                    adjusted_prices = apply_stock_splits(adjusted_prices, self.splits)
+            self._adjusted_prices = adjusted_prices
+        return self._adjusted_prices
+
+    def returns(self):
+        """Percentage returns, one row shorter than the panel"""
+        if self._returns is None:
+            adjusted = self.adjusted_prices()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self._returns = np.ascontiguousarray((adjusted[1:] / adjusted[:-1] - 1) * 100)
+        return self._returns
+
+    def resample(self, interval, n_days):
+        """Panel of compounded `interval` returns derived from this daily panel, no data is fetched again.
+        Daily returns are compounded into a growth index sampled at the end of each calendar period, or
+        every `n_days` rows (counted from the newest one) when the panel has no dates"""
+        if n_days <= 1 or len(self) < 2:
+            return self
+        daily_returns = self.returns()
+        levels = np.ones(self.shape, dtype=np.float64)
+        np.cumprod(1 + np.where(np.isnan(daily_returns), 0, daily_returns) / 100, axis=0, out=levels[1:])
+        levels[np.isnan(self.adjusted_prices())] = np.nan
+        if isinstance(self.index, pd.DatetimeIndex):
+            sampled = pd.DataFrame(levels, index=self.index).resample(RESAMPLE_RULES[interval]).last().dropna(how='all')
+            return PricePanel.from_prices(self.symbols, sampled.to_numpy(), index=sampled.index, dtype=self.dtype)
+        rows = np.arange(len(self) - 1, -1, -n_days)[::-1]
+        return PricePanel.from_prices(self.symbols, levels[rows], index=self.index[rows], dtype=self.dtype)
+
+    def returns_frame(self):
+        return pd.DataFrame(self.returns(), index=self.index[1:], columns=self.symbols, copy=False)
+
+    def has_gaps(self):
+        return bool(np.isnan(self.returns()).any())
+
+    def mean_returns(self):
+        if self.has_gaps():
+            # gaps after the join, let pandas skip them
+            return self.returns_frame().mean().to_numpy(dtype=np.float64)
+        return self.returns().mean(axis=0, dtype=np.float64)
+
+    def cov_matrix(self):
+        if self.has_gaps():
+            # pairwise-complete covariance, as pandas computes it
+            return self.returns_frame().cov().to_numpy(dtype=np.float64)
+        return np.atleast_2d(np.cov(self.returns(), rowvar=False))
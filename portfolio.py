@@ -0,0 +1,24 @@
+import numpy as np
+
+
+def tangent_portfolios(mean_returns, cov_solver, risk_free_returns):
+    """Tangent portfolio for every risk free return at once, z = cov^-1 (mu - rf) = cov^-1 mu - rf * cov^-1 1,
+    so the covariance is solved only twice whatever the number of rates.
+    Returns (weights with one row per rate, expected returns, std devs)"""
+    mean_returns = np.asarray(mean_returns, dtype=np.float64)
+    risk_free_returns = np.atleast_1d(np.asarray(risk_free_returns, dtype=np.float64))
+    solved = cov_solver.solve(np.column_stack([mean_returns, np.ones_like(mean_returns)]))
+    z_vectors = solved[:, 0][np.newaxis] - risk_free_returns[:, np.newaxis] * solved[:, 1][np.newaxis]
+    weights = z_vectors / z_vectors.sum(axis=1, keepdims=True)
+    return weights, weights @ mean_returns, np.sqrt(cov_solver.variance(weights))
+
+
+def optimal_portfolio_parameters(tangent_expected_return, tangent_std_dev, risk_free_return, k_risk_factor):
+    """Closed-form optimal split between tangent portfolio and risk free asset, all arguments broadcast.
+    Returns (A, optimal std dev, optimal expected return, risk free asset weight)"""
+    excess_return = risk_free_return - tangent_expected_return
+    optimal_portfolio_A = (tangent_std_dev ** 2) / (excess_return ** 2)
+    optimal_portfolio_std_dev = np.sqrt(1 / (4 * (k_risk_factor ** 2) * optimal_portfolio_A))
+    optimal_portfolio_expected_return = risk_free_return + (1 / (2 * k_risk_factor * optimal_portfolio_A))
+    risk_free_asset_weight = (optimal_portfolio_expected_return - tangent_expected_return) / excess_return
+    return optimal_portfolio_A, optimal_portfolio_std_dev, optimal_portfolio_expected_return, risk_free_asset_weight
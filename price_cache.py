@@ -0,0 +1,173 @@
+import logging as log
+import pandas as pd
+import numpy as np
+import threading
+import tempfile
+import shutil
+import json
+import time
+import os
+
+from instrumentation import count
+from panel import PricePanel, PRICE_COLUMNS
+from providers import DataFetchError, fetch_concurrently
+
+CACHE_COLUMN_FILES = {'Close': 'close.npy', 'Dividends': 'dividends.npy', 'Stock Splits': 'splits.npy'}
+CACHE_DATES_FILE = 'dates.npy'
+CACHE_META_FILE = 'meta.json'
+# cached histories older than this get the newer bars fetched
+REFRESH_AFTER_SECONDS = 3600
+
+
+class PriceHistoryCache():
+    """On-disk price history cache, one directory of column .npy files per symbol and interval"""
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3, max_age_days=30,
+                 refresh_after_seconds=REFRESH_AFTER_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.refresh_after_seconds = refresh_after_seconds
+        self.hits = 0
+        self.misses = 0
+        self.entry_locks = {}
+        self.entry_locks_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, symbol, interval):
+        return os.path.join(self.cache_dir, interval, symbol.replace(os.sep, '_'))
+
+    def _entry_lock(self, entry_dir):
+        with self.entry_locks_lock:
+            return self.entry_locks.setdefault(entry_dir, threading.Lock())
+
+    def _read(self, entry_dir):
+        meta_path = os.path.join(entry_dir, CACHE_META_FILE)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            dates = np.load(os.path.join(entry_dir, CACHE_DATES_FILE), mmap_mode='r')
+            columns = {column: np.load(os.path.join(entry_dir, file_name), mmap_mode='r')
+                       for column, file_name in CACHE_COLUMN_FILES.items()}
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError) as e:
+            log.warning(f'Price cache entry {entry_dir} is corrupt ({e}), fetching it again..')
+            return None, None
+        # an entry torn by a crash between its files has arrays of different lengths
+        if any(len(array) != meta.get('rows', len(dates)) for array in [dates, *columns.values()]):
+            log.warning(f'Price cache entry {entry_dir} is incomplete, fetching it again..')
+            return None, None
+        os.utime(meta_path)
+        return pd.DataFrame(columns, index=pd.DatetimeIndex(dates)), meta
+
+    def _replace_file(self, entry_dir, file_name, write):
+        """Writes into a unique temporary file of the entry, then atomically replaces `file_name` with it"""
+        fd, tmp_path = tempfile.mkstemp(prefix=f'.{file_name}.', suffix='.tmp', dir=entry_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                write(tmp_file)
+            os.replace(tmp_path, os.path.join(entry_dir, file_name))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _write(self, entry_dir, history, meta):
+        os.makedirs(entry_dir, exist_ok=True)
+        arrays = {CACHE_DATES_FILE: history.index.to_numpy(dtype='datetime64[ns]')}
+        for column, file_name in CACHE_COLUMN_FILES.items():
+            arrays[file_name] = history[column].to_numpy(dtype=np.float64)
+        for file_name, array in arrays.items():
+            self._replace_file(entry_dir, file_name, lambda array_file: np.save(array_file, array))
+        # meta goes last and records the row count, arrays not matching it are never read
+        meta = {**meta, 'rows': len(history)}
+        self._replace_file(entry_dir, CACHE_META_FILE, lambda meta_file: meta_file.write(json.dumps(meta).encode()))
+
+    def history(self, provider, symbol, interval, days):
+        """Returns the last `days` days of history, fetching only what is not cached yet"""
+        entry_dir = self._entry_dir(symbol, interval)
+        # concurrent requests of one symbol (overlapping panels, server requests) fetch and write it once
+        with self._entry_lock(entry_dir):
+            return self._history(provider, symbol, interval, days, entry_dir)
+
+    def _history(self, provider, symbol, interval, days, entry_dir):
+        window_start = pd.Timestamp.today().normalize() - pd.Timedelta(days=days)
+        cached, meta = self._read(entry_dir)
+
+        if cached is None or pd.Timestamp(meta['covered_from']) > window_start or not len(cached):
+            self.misses += 1
+            count('cache_misses')
+            history = self._fetch_window(provider, symbol, interval, days, window_start, entry_dir)
+        elif time.time() - meta['refreshed_at'] > self.refresh_after_seconds:
+            self.misses += 1
+            count('cache_misses')
+            # the last cached bar may still have been in progress, fetch it again with everything newer,
+            # the complete bar before it tells whether the provider adjusted the series since
+            check_date = cached.index[-2] if len(cached) > 1 else cached.index[-1]
+            newer = provider.history(symbol, interval, start=check_date)[PRICE_COLUMNS]
+            count('bytes_fetched', int(newer.memory_usage().sum()))
+            if self._adjusted_since(cached, newer, check_date):
+                log.debug(f'{symbol} was adjusted for a dividend or split, fetching its whole window again..')
+                history = self._fetch_window(provider, symbol, interval, days, window_start, entry_dir)
+            else:
+                history = pd.concat([cached, newer])
+                history = history[~history.index.duplicated(keep='last')].sort_index()
+                meta['refreshed_at'] = time.time()
+                self._write(entry_dir, history, meta)
+        else:
+            self.hits += 1
+            count('cache_hits')
+            history = cached
+        return history[history.index >= window_start]
+
+    def _fetch_window(self, provider, symbol, interval, days, window_start, entry_dir):
+        history = provider.history(symbol, interval, period=f'{days}d')[PRICE_COLUMNS]
+        count('bytes_fetched', int(history.memory_usage().sum()))
+        meta = {'covered_from': window_start.isoformat(), 'refreshed_at': time.time(), 'provider': provider.name}
+        self._write(entry_dir, history, meta)
+        return history
+
+    @staticmethod
+    def _adjusted_since(cached, newer, check_date):
+        """Adjusted closes (Yahoo's default) of the whole series change after every dividend or split,
+        newer bars cannot be appended to the cached ones then"""
+        if check_date not in newer.index:
+            return True
+        if not np.isclose(newer.at[check_date, 'Close'], cached.at[check_date, 'Close'], rtol=1e-6):
+            return True
+        events = newer.loc[newer.index > check_date, ['Dividends', 'Stock Splits']]
+        return bool((events.fillna(0) != 0).to_numpy().any())
+
+    def entries(self):
+        """Yields (entry_dir, size_in_bytes, last_access_time) of every cached entry"""
+        for interval in os.listdir(self.cache_dir):
+            interval_dir = os.path.join(self.cache_dir, interval)
+            if not os.path.isdir(interval_dir):
+                continue
+            for symbol in os.listdir(interval_dir):
+                entry_dir = os.path.join(interval_dir, symbol)
+                meta_path = os.path.join(entry_dir, CACHE_META_FILE)
+                if not os.path.exists(meta_path):
+                    continue
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+                yield entry_dir, size, os.path.getmtime(meta_path)
+
+    def evict(self):
+        """Drops entries unused for longer than max_age_days, then the least recently used ones above max_bytes"""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        oldest_allowed = time.time() - self.max_age_days * 24 * 3600
+        total_size = sum(size for _, size, _ in entries)
+        for entry_dir, size, last_access in entries:
+            if last_access >= oldest_allowed and total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+            log.debug(f'Evicted {entry_dir} from price cache')
+
+
+def panel_from_cache(price_cache, data_provider, symbols, interval, days, dtype=np.float64):
+    """Fetches histories of all symbols concurrently through the cache and aligns them into one panel"""
+    fetched, failures = fetch_concurrently(
+        lambda symbol: price_cache.history(data_provider, symbol, interval, days), symbols)
+    if failures:
+        raise DataFetchError(failures)
+    return PricePanel.from_histories(symbols, [fetched[symbol] for symbol in symbols], dtype=dtype)
@@ -0,0 +1,144 @@
+import logging as log
+import pandas as pd
+import contextvars
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from panel import normalize_history
+
+# Yahoo serves bursts of a few dozen requests per second per client before answering 429
+DEFAULT_REQUESTS_PER_SECOND = 50
+
+
+class SymbolNotFoundError(Exception):
+    """Raised by providers for symbols that do not exist, such fetches are not retried"""
+
+
+class RateLimiter():
+    """Thread-safe limiter spacing calls at most `max_calls_per_second` apart"""
+    def __init__(self, max_calls_per_second):
+        self.min_interval = 1 / max_calls_per_second if max_calls_per_second else 0
+        self.next_call_at = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.min_interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call_at)
+            self.next_call_at = call_at + self.min_interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+class DataProvider():
+    """Source of price histories, subclass it to plug in something else than Yahoo Finance"""
+    name = 'base'
+
+    def __init__(self, max_requests_per_second=None):
+        self.rate_limiter = RateLimiter(max_requests_per_second)
+
+    def history(self, symbol, interval, period=None, start=None):
+        """Returns Close, Dividends and Stock Splits indexed by tz-naive dates,
+        either for the last `period` (e.g. '500d') or for every bar since `start`"""
+        raise NotImplementedError
+
+    def info(self, symbol):
+        """Returns dict with at least 'symbol' and 'shortName', raises if symbol does not exist"""
+        raise NotImplementedError
+
+
+class YahooProvider(DataProvider):
+    name = 'yahoo'
+
+    def __init__(self, max_requests_per_second=DEFAULT_REQUESTS_PER_SECOND, session=None):
+        super().__init__(max_requests_per_second)
+        # yfinance shares one HTTP session between tickers unless a custom one is given
+        self.session = session
+
+    def _ticker(self, symbol):
+        import yfinance as yf
+        self.rate_limiter.wait()
+        return yf.Ticker(symbol, session=self.session)
+
+    def history(self, symbol, interval, period=None, start=None):
+        ticker = self._ticker(symbol)
+        if start is not None:
+            history = ticker.history(start=start, interval=interval)
+        else:
+            history = ticker.history(period=period, interval=interval)
+        return normalize_history(history)
+
+    def info(self, symbol):
+        try:
+            info = self._ticker(symbol).info
+        except Exception as e:
+            if '404' in str(e):
+                raise SymbolNotFoundError(symbol) from e
+            raise
+        if not info or 'symbol' not in info:
+            raise SymbolNotFoundError(symbol)
+        return {'symbol': info['symbol'], 'shortName': info.get('shortName', info['symbol'])}
+
+
+class LocalFakeProvider(DataProvider):
+    """Serves histories from in-memory frames, stands in for Yahoo in tests and benchmarks"""
+    name = 'local'
+
+    def __init__(self, histories, max_requests_per_second=None):
+        super().__init__(max_requests_per_second)
+        self.histories = histories
+        self.requests = []
+
+    def history(self, symbol, interval, period=None, start=None):
+        self.rate_limiter.wait()
+        self.requests.append((symbol, interval, period, start))
+        history = normalize_history(self.histories[symbol])
+        if start is not None:
+            return history[history.index >= pd.Timestamp(start)]
+        if period is not None:
+            return history[history.index > history.index[-1] - pd.Timedelta(period.upper())]
+        return history
+
+    def info(self, symbol):
+        if symbol not in self.histories:
+            raise SymbolNotFoundError(symbol)
+        return {'symbol': symbol, 'shortName': symbol}
+
+
+def fetch_concurrently(fetch, symbols, max_workers=32, retries=3, backoff_seconds=0.5):
+    """Calls fetch(symbol) for every unique symbol on a bounded thread pool, retrying failures
+    with exponential backoff. Returns (results, failures), both dicts keyed by symbol"""
+    def fetch_with_retries(symbol):
+        for attempt in range(retries + 1):
+            try:
+                return fetch(symbol)
+            except SymbolNotFoundError:
+                raise
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                log.debug(f'Fetching {symbol} failed ({e}), retrying..')
+                time.sleep(backoff_seconds * 2 ** attempt)
+
+    symbols = list(dict.fromkeys(symbols))
+    results, failures = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(symbols)))) as executor:
+        # fetches run in the caller's context, so bytes and cache hits count into its open spans
+        futures = {symbol: executor.submit(contextvars.copy_context().run, fetch_with_retries, symbol)
+                   for symbol in symbols}
+        for symbol, future in futures.items():
+            try:
+                results[symbol] = future.result()
+            except Exception as e:
+                failures[symbol] = e
+    return results, failures
+
+
+class DataFetchError(Exception):
+    """Raised when histories of some symbols could not be fetched"""
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__('Cannot fetch data for: ' + ', '.join(f'{symbol} ({error})' for symbol, error in failures.items()))
@@ -0,0 +1,267 @@
+import logging as log
+import threading
+import asyncio
+import json
+import time
+import os
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from batch import read_wallet_spec, wallet_rows, portfolio_result
+from constrained import PortfolioConstraints, ConstrainedOptimizer, constrained_portfolio_parameters
+from covariance import estimate_covariance, covariance_solver
+from file_loader import load_price_file
+from functions import N_DAYS_RETURNS_MAP, DEFAULT_CACHE_DIR
+from instrumentation import span
+from panel import PricePanel
+from portfolio import tangent_portfolios, optimal_portfolio_parameters
+from price_cache import PriceHistoryCache, panel_from_cache
+from providers import YahooProvider, DataFetchError, DEFAULT_REQUESTS_PER_SECOND
+from solvers import CovarianceError
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_BODY_BYTES = 1024 ** 2
+# panels are reloaded after this, API data get new bars during the day
+PANEL_MAX_AGE_SECONDS = 3600
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class LRUCache():
+    """Keeps up to `max_entries` results, least recently used dropped first. Concurrent requests of a key
+    being computed wait for that computation instead of starting their own"""
+    def __init__(self, max_entries, max_age_seconds=None):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.hits = self.misses = self.coalesced = 0
+
+    async def get(self, key, compute):
+        """Returns (result, time it was computed at), `compute` is a coroutine function run on a miss"""
+        if key in self.entries:
+            entry = self.entries[key]
+            if self.max_age_seconds is None or time.time() - entry[1] <= self.max_age_seconds:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            del self.entries[key]
+        if key in self.pending:
+            self.coalesced += 1
+            return await asyncio.shield(self.pending[key])
+        self.misses += 1
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            entry = (await compute(), time.time())
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # waiters get the exception, nobody may be waiting though
+            future.exception()
+            raise
+        finally:
+            del self.pending[key]
+        future.set_result(entry)
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        return {'entries': len(self.entries), 'max_entries': self.max_entries, 'hits': self.hits,
+                'misses': self.misses, 'coalesced': self.coalesced}
+
+
+class PortfolioServer():
+    """Answers optimal portfolio requests from warm state: daily price panels, covariance factorizations and
+    tangent portfolios stay in LRU caches, CPU heavy work runs on a thread pool (NumPy and BLAS release the GIL)
+    so the event loop keeps serving"""
+    def __init__(self, cache_dir=None, dtype='float64', workers=None, max_panels=32, max_factorizations=256,
+                 max_portfolios=4096, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+        self.dtype = dtype
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.price_cache = PriceHistoryCache(cache_dir or DEFAULT_CACHE_DIR)
+        self.data_provider = YahooProvider(requests_per_second)
+        self.panels = LRUCache(max_panels, PANEL_MAX_AGE_SECONDS)
+        self.factorizations = LRUCache(max_factorizations)
+        self.portfolios = LRUCache(max_portfolios)
+        self.pending_requests = {}
+        self.requests = self.coalesced_requests = 0
+
+    async def in_pool(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args))
+
+    def load_panel(self, source, symbols, days):
+        with span('fetch', source=source[0]):
+            if source[0] == 'file':
+                file_symbols, prices = load_price_file(source[1], dtype=self.dtype)
+                return PricePanel.from_prices(file_symbols, prices, dtype=self.dtype)
+            return panel_from_cache(self.price_cache, self.data_provider, list(symbols), '1d', days, dtype=self.dtype)
+
+    def factorize(self, panel, wallet):
+        """Mean returns and covariance solver of the wallet's interval over its horizon"""
+        settings = wallet['settings']
+        interval = settings['n_days_return_str']
+        if wallet['source'][0] == 'file' and wallet['symbols']:
+            missing_symbols = [symbol for symbol in wallet['symbols'] if symbol not in panel.symbols]
+            if missing_symbols:
+                raise ValueError(f'Symbols not found in {wallet["source"][1]}: {", ".join(missing_symbols)}')
+        with span('returns', interval=interval):
+            returns_panel = panel.subset(wallet['symbols'] if wallet['source'][0] == 'file' else None,
+                                         wallet_rows(panel, settings, wallet['source']))\
+                .resample(interval, N_DAYS_RETURNS_MAP[interval])
+        with span('covariance', model=settings['covariance_model']):
+            cov = estimate_covariance(returns_panel, settings['covariance_model'], settings['n_factors'])
+            mean_returns = returns_panel.mean_returns()
+        with span('solve', step='factorization'):
+            return {'symbols': returns_panel.symbols, 'mean_returns': mean_returns,
+                    'cov_solver': covariance_solver(cov), 'optimizer': ConstrainedOptimizer(),
+                    'optimizer_lock': threading.Lock()}
+
+    def solve(self, factorization, risk_free_return, k_risk_factor, constraints):
+        """Tangent portfolio for the rate, or the constrained portfolio (warm-started from the last one of
+        the same factorization) when the wallet has constraints"""
+        with span('solve', constrained=constraints.active):
+            if not constraints.active:
+                return tangent_portfolios(factorization['mean_returns'], factorization['cov_solver'], risk_free_return)
+            # the warm start is shared by requests of the factorization, one of them solves at a time
+            with factorization['optimizer_lock']:
+                weights = factorization['optimizer'].solve(factorization['mean_returns'], factorization['cov_solver'],
+                                                           risk_free_return, k_risk_factor, constraints)
+            return constrained_portfolio_parameters(weights, factorization['mean_returns'],
+                                                    factorization['cov_solver'], risk_free_return)
+
+    async def evaluate(self, wallet_spec):
+        wallet = read_wallet_spec(wallet_spec, 'wallet')
+        settings = wallet['settings']
+        symbols = tuple(wallet['symbols']) if wallet['source'][0] == 'api' else None
+        panel_key = (wallet['source'], symbols, settings['time_horizon_in_days'] if symbols else None)
+        panel, loaded_at = await self.panels.get(panel_key, lambda: self.in_pool(
+            self.load_panel, wallet['source'], symbols, settings['time_horizon_in_days']))
+
+        # the panel's load time is part of the key, reloaded panels do not reuse older factorizations
+        factorization_key = (panel_key, loaded_at, tuple(wallet['symbols'] or []), settings['time_horizon_in_days'],
+                             settings['n_days_return_str'], settings['covariance_model'], settings['n_factors'])
+        factorization, _ = await self.factorizations.get(factorization_key,
+                                                         lambda: self.in_pool(self.factorize, panel, wallet))
+
+        risk_free_return = settings['risk_free_asset_expected_return'] * \
+            N_DAYS_RETURNS_MAP[settings['n_days_return_str']] / 365
+        constraints = PortfolioConstraints(settings['long_only'], settings['max_asset_weight'], settings['max_leverage'])
+        # unconstrained tangent portfolio does not depend on k, constrained one does
+        portfolio_key = (factorization_key, risk_free_return) if not constraints.active else \
+            (factorization_key, risk_free_return, settings['k_risk_factor'], settings['long_only'],
+             settings['max_asset_weight'], settings['max_leverage'])
+        portfolio, _ = await self.portfolios.get(portfolio_key, lambda: self.in_pool(
+            self.solve, factorization, risk_free_return, settings['k_risk_factor'], constraints))
+
+        with span('allocation'):
+            if constraints.active:
+                return portfolio_result(factorization['symbols'], constraints, settings['budget'], *portfolio)
+            weights, tangent_expected_return, tangent_std_dev = portfolio
+            _, optimal_std_dev, optimal_expected_return, risk_free_asset_weight = optimal_portfolio_parameters(
+                tangent_expected_return, tangent_std_dev, risk_free_return, settings['k_risk_factor'])
+            return portfolio_result(factorization['symbols'], constraints, settings['budget'], weights,
+                                    tangent_expected_return, tangent_std_dev, optimal_expected_return,
+                                    optimal_std_dev, risk_free_asset_weight)
+
+    async def evaluate_coalesced(self, wallet_spec):
+        """Identical requests arriving while one is being answered share its answer"""
+        self.requests += 1
+        request_key = json.dumps(wallet_spec, sort_keys=True)
+        if request_key in self.pending_requests:
+            self.coalesced_requests += 1
+            return await asyncio.shield(self.pending_requests[request_key])
+        task = self.pending_requests[request_key] = asyncio.ensure_future(self.evaluate(wallet_spec))
+        try:
+            return await asyncio.shield(task)
+        finally:
+            del self.pending_requests[request_key]
+
+    def stats(self):
+        return {'requests': self.requests, 'coalesced_requests': self.coalesced_requests,
+                'panels': self.panels.stats(), 'factorizations': self.factorizations.stats(),
+                'portfolios': self.portfolios.stats(),
+                'price_cache': {'hits': self.price_cache.hits, 'misses': self.price_cache.misses}}
+
+    async def route(self, method, path, body):
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        if path == '/stats':
+            return 200, self.stats()
+        if path != '/portfolio':
+            return 404, {'error': f'Unknown path {path}, use /portfolio, /stats or /health'}
+        if method != 'POST':
+            return 405, {'error': 'Send wallet spec with POST'}
+        try:
+            wallet_spec = json.loads(body)
+            if not isinstance(wallet_spec, dict):
+                raise ValueError('Wallet spec must be a JSON object')
+            return 200, await self.evaluate_coalesced(wallet_spec)
+        except (ValueError, TypeError, DataFetchError, CovarianceError) as e:
+            return 400, {'error': str(e)}
+        except KeyError as e:
+            return 400, {'error': f'Missing {e}'}
+        except OSError as e:
+            # wallet's file cannot be read
+            return 400, {'error': str(e)}
+        except Exception as e:
+            log.error(f'Cannot calculate portfolio! Reason: {e}')
+            return 500, {'error': str(e)}
+
+    async def handle_connection(self, reader, writer):
+        """Minimal HTTP/1.1 with keep-alive, one JSON request and response at a time"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header_line = await reader.readline()
+                    if not header_line.strip():
+                        break
+                    name, value = header_line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get('content-length', 0))
+                if content_length > MAX_BODY_BYTES:
+                    status, response = 413, {'error': f'Request body above {MAX_BODY_BYTES} bytes'}
+                    headers['connection'] = 'close'
+                else:
+                    body = await reader.readexactly(content_length)
+                    status, response = await self.route(method, target.split('?')[0], body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                payload = json.dumps(response).encode()
+                writer.write(f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(payload)}\r\nConnection: {"keep-alive" if keep_alive else "close"}'
+                             '\r\n\r\n'.encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # malformed request or client gone, nothing to answer
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        log.info(f'Serving portfolios on http://{host}:{port}/portfolio')
+        async with server:
+            await server.serve_forever()
+
+
+def run_server(host=DEFAULT_HOST, port=DEFAULT_PORT, cache_dir=None, dtype='float64', workers=None,
+               requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    portfolio_server = PortfolioServer(cache_dir, dtype, workers, requests_per_second=requests_per_second)
+    try:
+        asyncio.run(portfolio_server.serve(host, port))
+    except KeyboardInterrupt:
+        log.info('Server stopped.')
+    finally:
+        portfolio_server.executor.shutdown(wait=False)
@@ -0,0 +1,153 @@
+import pandas as pd
+import numpy as np
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from covariance import FactorCovariance
+
+PERCENTILE_LEVELS = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+# values drawn per chunk, bounds memory whatever the amount of paths and stocks
+CHUNK_VALUES = 1 << 22
+# single precision halves the cost of drawing, its 7 significant digits are far below the sampling error
+DRAW_DTYPE = np.float32
+
+# sampler and investments of the simulation a worker process draws chunks of, sent once per worker
+_worker_simulation = None
+
+
+class CorrelatedGrowthSampler():
+    """Draws correlated growth of every stock over any amount of periods. Period returns are lognormal with the
+    wallet's mean vector and covariance (matched on gross returns), so log growth over T periods is normal with
+    T times the moments of one period and every path takes one draw per stock whatever the amount of periods.
+    Cholesky factor of the log covariance for dense covariance, factors plus idiosyncratic noise for factor models"""
+    def __init__(self, mean_returns, cov):
+        self.gross_means = 1 + np.asarray(mean_returns, dtype=np.float64) / 100
+        self.cholesky = None
+        if isinstance(cov, FactorCovariance):
+            # factor structure is kept with the log covariance matched to first order, (C / g g^T)
+            self.loadings = (cov.loadings / 100 / self.gross_means[:, None]).astype(DRAW_DTYPE)
+            self.idiosyncratic_std_devs = (np.sqrt(cov.idiosyncratic_variances) / 100 / self.gross_means)\
+                .astype(DRAW_DTYPE)
+            log_variances = np.sum(self.loadings.astype(np.float64) ** 2, axis=1) + \
+                self.idiosyncratic_std_devs.astype(np.float64) ** 2
+        else:
+            log_cov = np.log1p(np.asarray(cov, dtype=np.float64) / 10000 / np.outer(self.gross_means, self.gross_means))
+            try:
+                cholesky = np.linalg.cholesky(log_cov)
+            except np.linalg.LinAlgError:
+                # positive semi-definite only, square root from eigendecomposition
+                eigenvalues, eigenvectors = np.linalg.eigh(log_cov)
+                cholesky = eigenvectors * np.sqrt(np.maximum(eigenvalues, 0))
+            self.cholesky = cholesky.astype(DRAW_DTYPE)
+            log_variances = np.diag(log_cov)
+        self.log_means = np.log(self.gross_means) - log_variances / 2
+
+    def draw_growth(self, generator, n_paths, periods=1):
+        """(n_paths x stocks) growth factors over `periods` periods. Paths come in antithetic pairs (the second
+        half mirrors deviations of the first), half the normals are drawn and spread is estimated more precisely"""
+        n_stocks = len(self.gross_means)
+        half = (n_paths + 1) // 2
+        if self.cholesky is not None:
+            deviations = generator.standard_normal((half, n_stocks), dtype=DRAW_DTYPE) @ self.cholesky.T
+        else:
+            deviations = generator.standard_normal((half, self.loadings.shape[1]), dtype=DRAW_DTYPE) @ \
+                self.loadings.T
+            deviations += generator.standard_normal((half, n_stocks), dtype=DRAW_DTYPE) * \
+                self.idiosyncratic_std_devs
+        log_growth = np.concatenate([deviations, -deviations[:n_paths - half]])
+        log_growth *= np.sqrt(periods)
+        log_growth += (self.log_means * periods).astype(DRAW_DTYPE)
+        return np.exp(log_growth, out=log_growth)
+
+    def portfolio_log_moments(self, weights):
+        """Mean and std dev of the log of one period's gross return of a portfolio rebalanced to `weights`"""
+        gross_mean = weights @ self.gross_means
+        if self.cholesky is not None:
+            # covariance of gross returns is recovered exactly from the log covariance
+            log_cov = self.cholesky.astype(np.float64) @ self.cholesky.T.astype(np.float64)
+            gross_cov = np.expm1(log_cov) * np.outer(self.gross_means, self.gross_means)
+            variance = weights @ gross_cov @ weights
+        else:
+            scaled_weights = weights * self.gross_means
+            variance = np.sum((scaled_weights @ self.loadings) ** 2) + \
+                np.sum((scaled_weights * self.idiosyncratic_std_devs) ** 2)
+        log_variance = np.log1p(variance / gross_mean ** 2)
+        return np.log(gross_mean) - log_variance / 2, np.sqrt(log_variance)
+
+
+class SimulationResult():
+    """Simulated final values of the budget split between risk assets and risk free asset"""
+    def __init__(self, final_values, budget):
+        self.final_values = final_values
+        self.budget = budget
+
+    def percentiles(self, levels=PERCENTILE_LEVELS):
+        values = np.percentile(self.final_values, levels)
+        return pd.DataFrame({'percentile': levels, 'final_value': values,
+                             'return_in_percents': (values / self.budget - 1) * 100})
+
+    def probability_of_loss(self, loss=0):
+        """Chance of losing more than `loss` USD"""
+        return float(np.mean(self.final_values < self.budget - loss))
+
+    def value_at_risk(self, confidence=0.95):
+        return float(self.budget - np.quantile(self.final_values, 1 - confidence))
+
+    def conditional_value_at_risk(self, confidence=0.95):
+        threshold = np.quantile(self.final_values, 1 - confidence)
+        return float(self.budget - self.final_values[self.final_values <= threshold].mean())
+
+
+def simulate_chunk(sampler, risk_assets_investments, risk_free_asset_investment, risk_free_return, periods,
+                   n_paths, seed_sequence, rebalanced):
+    generator = np.random.default_rng(seed_sequence)
+    risk_free_value = risk_free_asset_investment * (1 + risk_free_return) ** periods
+    risky_budget = risk_assets_investments.sum()
+    if rebalanced:
+        # weights restored every period, log growth of the portfolio is one normal variable per path
+        if not risky_budget:
+            return np.full(n_paths, risk_free_value)
+        log_mean, log_std_dev = sampler.portfolio_log_moments(risk_assets_investments / risky_budget)
+        growth = np.exp(generator.normal(log_mean * periods, log_std_dev * np.sqrt(periods), n_paths))
+        return risky_budget * growth + risk_free_value
+    # buy and hold, every stock grows along its own correlated path
+    growth = sampler.draw_growth(generator, n_paths, periods)
+    return growth @ risk_assets_investments.astype(DRAW_DTYPE) + risk_free_value
+
+
+def init_simulation_worker(*simulation):
+    global _worker_simulation
+    _worker_simulation = simulation
+
+
+def simulate_worker_chunk(n_paths, seed_sequence):
+    sampler, risk_assets_investments, risk_free_asset_investment, risk_free_return, periods, rebalanced = \
+        _worker_simulation
+    return simulate_chunk(sampler, risk_assets_investments, risk_free_asset_investment, risk_free_return, periods,
+                          n_paths, seed_sequence, rebalanced)
+
+
+def simulate_portfolio(mean_returns, cov, risk_assets_investments, risk_free_asset_investment, risk_free_return,
+                       periods=1, n_paths=1000000, seed=None, processes=None, rebalanced=False):
+    """Final values of the investments after `periods` periods of returns (in percents, like the wallet's).
+    Paths are drawn in chunks with their own seed spawned from `seed`, so results are the same whatever
+    the amount of processes (all cores by default). Worker processes get the sampler once, chunks carry only
+    their amount of paths and seed"""
+    sampler = CorrelatedGrowthSampler(mean_returns, cov)
+    risk_assets_investments = np.asarray(risk_assets_investments, dtype=np.float64)
+    chunk_paths = max(1000, CHUNK_VALUES // max(len(risk_assets_investments), 1))
+    chunk_sizes = [min(chunk_paths, n_paths - start) for start in range(0, n_paths, chunk_paths)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    simulation = (sampler, risk_assets_investments, risk_free_asset_investment, risk_free_return, periods, rebalanced)
+    processes = min(processes or os.cpu_count() or 1, len(chunk_sizes))
+    # rebalanced chunks are one draw per path, cheaper than starting processes
+    if processes > 1 and not rebalanced:
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_simulation_worker,
+                                 initargs=simulation) as executor:
+            final_values = list(executor.map(simulate_worker_chunk, chunk_sizes, seed_sequences))
+    else:
+        final_values = [simulate_chunk(sampler, risk_assets_investments, risk_free_asset_investment, risk_free_return,
+                                       periods, chunk_size, seed_sequence, rebalanced)
+                        for chunk_size, seed_sequence in zip(chunk_sizes, seed_sequences)]
+    budget = risk_assets_investments.sum() + risk_free_asset_investment
+    return SimulationResult(np.concatenate(final_values).astype(np.float64, copy=False), budget)
@@ -0,0 +1,70 @@
+import logging as log
+import numpy as np
+
+MAX_CONDITION_NUMBER = 1e10
+
+
+class CovarianceError(Exception):
+    """Raised when covariance matrix cannot give a meaningful portfolio (e.g. it is not positive semi-definite)"""
+
+
+class CovarianceSolver():
+    """Factorizes covariance matrix once and reuses it for every solve and variance query on it.
+    Cholesky when the matrix is positive definite, eigendecomposition with tiny eigenvalues dropped otherwise"""
+    def __init__(self, cov_matrix, eigenvalue_tolerance=1e-12):
+        self.cov_matrix = np.ascontiguousarray(cov_matrix, dtype=np.float64)
+        if not np.isfinite(self.cov_matrix).all():
+            raise CovarianceError('Covariance matrix contains missing values, some stock has too little data!')
+        self.method = None
+        self.condition_number = np.inf
+        try:
+            self._factorize_cholesky()
+        except np.linalg.LinAlgError:
+            self._factorize_eigen(eigenvalue_tolerance)
+        if self.condition_number > MAX_CONDITION_NUMBER:
+            log.warning(f'Covariance matrix is ill-conditioned (condition number ~{self.condition_number:.2e}), '
+                        'weights may be unstable. Consider longer time horizon or fewer stocks.')
+
+    def _factorize_cholesky(self):
+        cholesky_factor = np.linalg.cholesky(self.cov_matrix)
+        # numpy has no triangular solve, the inverse of the triangular factor is formed once
+        # so that every solve is two matrix-vector products
+        self.inverse_cholesky = np.linalg.inv(cholesky_factor)
+        diagonal = np.diag(cholesky_factor)
+        # cheap lower bound of the real condition number
+        self.condition_number = (diagonal.max() / diagonal.min()) ** 2
+        self.method = 'cholesky'
+
+    def _factorize_eigen(self, eigenvalue_tolerance):
+        eigenvalues, self.eigenvectors = np.linalg.eigh(self.cov_matrix)
+        largest = max(eigenvalues.max(), 0)
+        if eigenvalues.min() < -eigenvalue_tolerance * largest:
+            log.warning('Covariance matrix is not positive semi-definite, probably because of missing data.')
+        kept = eigenvalues > eigenvalue_tolerance * largest
+        if not kept.any():
+            raise CovarianceError('Covariance matrix has no positive eigenvalues!')
+        self.inverted_eigenvalues = np.where(kept, 1 / np.where(kept, eigenvalues, 1), 0)
+        self.condition_number = np.inf if not kept.all() else largest / eigenvalues.min()
+        self.method = 'eigen'
+
+    def solve(self, vector):
+        """Returns cov_matrix^-1 @ vector without forming the inverse (pseudo-inverse on the eigen path)"""
+        if self.method == 'cholesky':
+            return self.inverse_cholesky.T @ (self.inverse_cholesky @ vector)
+        return self.eigenvectors @ (self.inverted_eigenvalues.reshape((-1,) + (1,) * (np.ndim(vector) - 1)) *
+                                    (self.eigenvectors.T @ vector))
+
+    def multiply(self, weights):
+        """cov_matrix @ w for one weight vector, or for each row of 2-D weights"""
+        return np.asarray(weights, dtype=np.float64) @ self.cov_matrix
+
+    def variance(self, weights):
+        """w^T cov_matrix w for one weight vector, or for each row of 2-D weights"""
+        weights = np.asarray(weights, dtype=np.float64)
+        variance = np.einsum('...i,...i->...', weights @ self.cov_matrix, weights)
+        # rounding noise of a positive semi-definite matrix stays well below the diagonal contribution
+        scale = (weights ** 2) @ np.abs(np.diag(self.cov_matrix))
+        if np.any(variance < -1e-10 * scale):
+            raise CovarianceError(f'Portfolio variance is negative ({np.min(variance):.4g}), covariance matrix '
+                                  'is not positive semi-definite, probably because of missing data.')
+        return np.maximum(variance, 0)
@@ -0,0 +1,54 @@
+from instrumentation import span
+
+WALLET_STAGES = {
+    'prices': [],
+    'returns': ['prices'],
+    'mean': ['returns'],
+    'cov': ['returns'],
+    'factorization': ['cov'],
+    'tangent': ['mean', 'factorization'],
+    'tangent_parameters': ['tangent', 'mean', 'cov'],
+    'optimal': ['tangent_parameters'],
+    'constrained': ['mean', 'cov'],
+    'allocation': ['optimal', 'constrained'],
+}
+# instrumentation span each stage is computed in
+STAGE_SPANS = {'prices': 'fetch', 'returns': 'returns', 'mean': 'covariance', 'cov': 'covariance',
+               'factorization': 'solve', 'tangent': 'solve', 'tangent_parameters': 'solve', 'optimal': 'solve',
+               'constrained': 'solve', 'allocation': 'allocation'}
+
+
+class StageGraph():
+    """Cached intermediate results of the portfolio pipeline, a stage is dropped together with everything downstream.
+    A stage can keep several results side by side under different keys (e.g. one per return interval)"""
+    def __init__(self, dependencies=WALLET_STAGES):
+        self.dependencies = dependencies
+        self.dependents = {stage: [dependent for dependent, upstream in dependencies.items() if stage in upstream]
+                           for stage in dependencies}
+        self.results = {}
+
+    def get(self, stage, compute, key=None):
+        stage_results = self.results.setdefault(stage, {})
+        if key not in stage_results:
+            with span(STAGE_SPANS.get(stage, stage), step=stage, key=key):
+                stage_results[key] = compute()
+        return stage_results[key]
+
+    def set(self, stage, result, key=None):
+        """Puts already known result (e.g. loaded from a saved wallet) into the graph"""
+        self.results.setdefault(stage, {})[key] = result
+
+    def is_cached(self, stage, key=None):
+        return key in self.results.get(stage, {})
+
+    def cached(self, stage):
+        """All cached results of a stage, keyed"""
+        return dict(self.results.get(stage, {}))
+
+    def invalidate(self, stage):
+        self.results.pop(stage, None)
+        for dependent in self.dependents[stage]:
+            self.invalidate(dependent)
+
+    def clear(self):
+        self.results = {}
@@ -0,0 +1,54 @@
+import pandas as pd
+import numpy as np
+
+from constrained import constrained_portfolio_parameters, ConstrainedOptimizer
+from portfolio import tangent_portfolios, optimal_portfolio_parameters
+
+SWEEP_COLUMNS = ['k_risk_factor', 'risk_free_asset_expected_return', 'tangent_portfolio_expected_return',
+                 'tangent_portfolio_std_dev', 'optimal_portfolio_expected_return', 'optimal_portfolio_std_dev',
+                 'risk_free_asset_weight', 'optimal_portfolio_risk_assets_weight']
+
+
+def sweep_portfolios(mean_returns, cov_solver, k_risk_factors, risk_free_returns, symbols=None,
+                     years_part_of_return=1, constraints=None, optimizer=None):
+    """Optimal portfolio for every (k, risk free rate) grid point in batched NumPy.
+    Risk free rates are yearly, as the wallet keeps them, and are scaled by `years_part_of_return` like
+    in the interactive mode. With active `constraints` every grid point is solved by the constrained optimizer
+    (warm-started from its previous sweep when given). Returns a table with one row per grid point and
+    the weight of every stock in the whole optimal portfolio"""
+    k_risk_factors = np.atleast_1d(np.asarray(k_risk_factors, dtype=np.float64))
+    risk_free_returns = np.atleast_1d(np.asarray(risk_free_returns, dtype=np.float64))
+    risk_free_returns_in_horizon = risk_free_returns * years_part_of_return
+    rate_index, k_index = [grid.ravel() for grid in
+                           np.meshgrid(np.arange(len(risk_free_returns)), np.arange(len(k_risk_factors)), indexing='ij')]
+
+    if constraints is not None and constraints.active:
+        optimizer = optimizer or ConstrainedOptimizer()
+        weights = optimizer.solve(mean_returns, cov_solver, risk_free_returns_in_horizon[rate_index],
+                                  k_risk_factors[k_index], constraints)
+        _, tangent_expected_returns, tangent_std_devs, optimal_expected_returns, optimal_std_devs, \
+            risk_free_asset_weights = constrained_portfolio_parameters(weights, mean_returns, cov_solver,
+                                                                       risk_free_returns_in_horizon[rate_index])
+    else:
+        # tangent portfolio depends only on the rate, k only rescales the split
+        tangent_weights, tangent_expected_returns, tangent_std_devs = [
+            parameter[rate_index] for parameter in
+            tangent_portfolios(mean_returns, cov_solver, risk_free_returns_in_horizon)]
+        _, optimal_std_devs, optimal_expected_returns, risk_free_asset_weights = optimal_portfolio_parameters(
+            tangent_expected_returns, tangent_std_devs, risk_free_returns_in_horizon[rate_index],
+            k_risk_factors[k_index])
+        weights = tangent_weights * (1 - risk_free_asset_weights)[:, np.newaxis]
+    risk_assets_weights = 1 - risk_free_asset_weights
+
+    table = pd.DataFrame(np.column_stack([
+        k_risk_factors[k_index], risk_free_returns[rate_index], tangent_expected_returns,
+        tangent_std_devs, optimal_expected_returns, optimal_std_devs,
+        risk_free_asset_weights, risk_assets_weights]), columns=SWEEP_COLUMNS)
+    if symbols is None:
+        symbols = [f'asset_{i}' for i in range(weights.shape[1])]
+    stock_weights = pd.DataFrame(weights, columns=[f'weight_{symbol}' for symbol in symbols])
+    return pd.concat([table, stock_weights], axis=1)
+
+
+def export_sweep(table, file_path):
+    table.to_csv(file_path, index=False)
@@ -0,0 +1,30 @@
+import numpy as np
+
+from backtest import RollingMoments, run_backtest
+
+
+def returns(periods=120, n_stocks=4, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(0.05, 1.0, (periods, n_stocks)) + rng.normal(0, 0.5, (periods, 1))
+
+
+def test_rolling_moments_match_window_after_adds_and_removes():
+    data = returns()
+    window, step = 40, 7
+    moments = RollingMoments(data[:window])
+    for start in range(window + step, len(data), step):
+        moments.add(data[start - step:start])
+        moments.remove(data[start - step - window:start - window])
+        np.testing.assert_allclose(moments.mean(), data[start - window:start].mean(axis=0), atol=1e-12)
+        np.testing.assert_allclose(moments.cov(), np.cov(data[start - window:start].T), atol=1e-12)
+
+
+def test_incremental_backtest_matches_recomputing_every_window():
+    data = returns()
+    incremental = run_backtest(data, 40, 5, risk_free_return=0.01, k_risk_factor=2, recompute_every=4)
+    recomputed = run_backtest(data, 40, 5, risk_free_return=0.01, k_risk_factor=2, recompute_every=1)
+
+    np.testing.assert_allclose(incremental.weights.to_numpy(), recomputed.weights.to_numpy(), atol=1e-9)
+    np.testing.assert_allclose(incremental.portfolio_returns.to_numpy(), recomputed.portfolio_returns.to_numpy(),
+                               atol=1e-9)
+    assert len(incremental.portfolio_returns) == len(data) - 40
@@ -0,0 +1,20 @@
+import json
+
+from batch import read_batch_spec
+
+
+def test_invalid_wallet_specs_fail_alone(tmp_path):
+    spec_path = tmp_path / 'spec.json'
+    spec_path.write_text(json.dumps({'wallets': [
+        {'name': 'valid', 'symbols': ['AAA'], 'k_risk_factor': 2},
+        {'name': 'no_k', 'symbols': ['AAA']},
+        {'name': 'bad_interval', 'symbols': ['AAA'], 'k_risk_factor': 2, 'n_days_return_str': '2d'},
+        {'k_risk_factor': 2},
+    ]}))
+
+    wallets, failures = read_batch_spec(str(spec_path))
+
+    assert [wallet['name'] for wallet in wallets] == ['valid', 'no_k', 'bad_interval', 'wallet_3']
+    assert sorted(failures) == [1, 2, 3]
+    assert 'k_risk_factor' in failures[1]
+    assert wallets[0]['settings']['k_risk_factor'] == 2
@@ -0,0 +1,88 @@
+import numpy as np
+
+from constrained import PortfolioConstraints, ConstrainedOptimizer, constrained_portfolios
+from solvers import CovarianceSolver
+
+
+def problem(n_stocks=8, seed=0):
+    rng = np.random.default_rng(seed)
+    returns = rng.normal(0.2, 2.0, (200, n_stocks)) + rng.normal(0, 1.0, (200, 1))
+    return returns.mean(axis=0), np.cov(returns.T)
+
+
+def test_projection_meets_box_and_leverage_kkt_conditions():
+    constraints = PortfolioConstraints(max_asset_weight=0.3, max_leverage=1)
+    weights = np.random.default_rng(1).normal(0, 0.5, (20, 10))
+
+    projected = constraints.project(weights)
+
+    for row, projected_row in zip(weights, projected):
+        magnitudes, projected_magnitudes = np.abs(row), np.abs(projected_row)
+        assert projected_magnitudes.max() <= 0.3 + 1e-12
+        assert projected_magnitudes.sum() <= 1 + 1e-9
+        assert np.all((projected_row == 0) | (np.sign(projected_row) == np.sign(row)))
+        # |w| = clip(|v| - t, 0, cap) with t >= 0, and t > 0 only when leverage is exhausted
+        between = (projected_magnitudes > 0) & (projected_magnitudes < 0.3)
+        threshold = (magnitudes - projected_magnitudes)[between].mean() if between.any() else 0
+        np.testing.assert_allclose((magnitudes - projected_magnitudes)[between], threshold, atol=1e-9)
+        assert np.all(magnitudes[projected_magnitudes == 0] <= threshold + 1e-9)
+        assert np.all(magnitudes[projected_magnitudes == 0.3] - 0.3 >= threshold - 1e-9)
+        if threshold > 1e-9:
+            assert np.isclose(projected_magnitudes.sum(), 1)
+
+
+def test_long_only_projection_drops_short_positions():
+    projected = PortfolioConstraints(long_only=True).project([0.5, -0.2, 0.1])
+
+    np.testing.assert_array_equal(projected, [0.5, 0, 0.1])
+
+
+def test_loose_constraints_give_the_closed_form_portfolio():
+    mean_returns, cov = problem()
+    cov_solver = CovarianceSolver(cov)
+
+    weights, _ = constrained_portfolios(mean_returns, cov_solver, 0.05, 2, PortfolioConstraints(max_asset_weight=100),
+                                        tolerance=1e-12, max_iterations=100000)
+
+    np.testing.assert_allclose(weights[0], cov_solver.solve(mean_returns - 0.05) / 4, atol=1e-6)
+
+
+def test_long_only_capped_portfolio_meets_kkt_conditions():
+    mean_returns, cov = problem()
+    constraints = PortfolioConstraints(long_only=True, max_asset_weight=0.25)
+
+    weights, _ = constrained_portfolios(mean_returns, CovarianceSolver(cov), 0.05, [1, 4], constraints,
+                                        tolerance=1e-12, max_iterations=100000)
+
+    for row, k in zip(weights, [1, 4]):
+        gradient = 2 * k * cov @ row - (mean_returns - 0.05)
+        between = (row > 1e-9) & (row < 0.25 - 1e-9)
+        np.testing.assert_allclose(gradient[between], 0, atol=1e-6)
+        assert np.all(gradient[row <= 1e-9] >= -1e-6)
+        assert np.all(gradient[row >= 0.25 - 1e-9] <= 1e-6)
+
+
+def test_warm_start_of_other_shape_is_dropped():
+    constraints = PortfolioConstraints(long_only=True)
+    optimizer = ConstrainedOptimizer()
+    mean_returns, cov = problem(n_stocks=8)
+    optimizer.solve(mean_returns, CovarianceSolver(cov), 0.05, 2, constraints)
+
+    mean_returns, cov = problem(n_stocks=5, seed=3)
+    warm = optimizer.solve(mean_returns, CovarianceSolver(cov), 0.05, [1, 2, 4], constraints)
+    cold, _ = constrained_portfolios(mean_returns, CovarianceSolver(cov), 0.05, [1, 2, 4], constraints)
+
+    assert warm.shape == (3, 5)
+    np.testing.assert_allclose(warm, cold, atol=1e-7)
+
+
+def test_warm_start_converges_faster():
+    mean_returns, cov = problem()
+    constraints = PortfolioConstraints(long_only=True, max_asset_weight=0.3)
+    optimizer = ConstrainedOptimizer()
+    optimizer.solve(mean_returns, CovarianceSolver(cov), 0.05, 2, constraints)
+    cold_iterations = optimizer.iterations
+
+    optimizer.solve(mean_returns, CovarianceSolver(cov), 0.05, 2.1, constraints)
+
+    assert optimizer.iterations < cold_iterations
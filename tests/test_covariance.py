@@ -0,0 +1,50 @@
+import numpy as np
+
+from backtest import run_backtest, markowitz_weights
+from covariance import ledoit_wolf_covariance, FactorCovariance, covariance_solver
+
+
+def returns(periods=80, n_stocks=6, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.normal(0.05, 1.0, (periods, n_stocks)) + rng.normal(0, 0.7, (periods, 1))
+
+
+def test_ledoit_wolf_solve_matches_dense_solve():
+    cov = ledoit_wolf_covariance(returns())
+    vectors = np.random.default_rng(2).normal(size=(6, 3))
+
+    np.testing.assert_allclose(covariance_solver(cov).solve(vectors), np.linalg.solve(cov, vectors), rtol=1e-9)
+
+
+def test_ledoit_wolf_shrinks_towards_scaled_identity():
+    data = returns(periods=20, n_stocks=10)
+    demeaned = data - data.mean(axis=0)
+    sample_cov = demeaned.T @ demeaned / len(data)
+    cov = ledoit_wolf_covariance(data)
+
+    off_diagonal = ~np.eye(10, dtype=bool)
+    assert np.isclose(np.trace(cov), np.trace(sample_cov))
+    assert np.abs(cov[off_diagonal]).sum() < np.abs(sample_cov[off_diagonal]).sum()
+
+
+def test_woodbury_solve_matches_dense_solve():
+    for periods, n_stocks in [(80, 6), (5, 12)]:
+        cov = FactorCovariance(returns(periods, n_stocks), n_factors=2)
+        dense = cov.to_dense()
+        vector = np.random.default_rng(3).normal(size=n_stocks)
+        weights = np.random.default_rng(4).normal(size=(2, n_stocks))
+
+        np.testing.assert_allclose(cov.solve(vector), np.linalg.solve(dense, vector), rtol=1e-8)
+        np.testing.assert_allclose(cov.multiply(weights), weights @ dense, rtol=1e-12)
+        np.testing.assert_allclose(cov.variance(weights), np.einsum('ij,jk,ik->i', weights, dense, weights),
+                                   rtol=1e-12)
+
+
+def test_backtest_uses_the_covariance_model_of_each_window():
+    data = returns()
+    result = run_backtest(data, 40, 10, risk_free_return=0.01, k_risk_factor=2, covariance_model='shrinkage')
+
+    for rebalance, start in enumerate(range(40, len(data), 10)):
+        window_returns = data[start - 40:start]
+        expected, _ = markowitz_weights(window_returns.mean(axis=0), ledoit_wolf_covariance(window_returns), 0.01, 2)
+        np.testing.assert_allclose(result.weights.iloc[rebalance].to_numpy(), expected, rtol=1e-9)
@@ -0,0 +1,34 @@
+import numpy as np
+
+from file_loader import load_price_file, SIDECAR_PRICES_SUFFIX, SIDECAR_META_SUFFIX
+
+
+def price_file(tmp_path, rows=500):
+    file_name = str(tmp_path / 'prices.csv')
+    with open(file_name, 'w') as price_file:
+        price_file.write('AAA;BBB\n' + ''.join(f'{i};{2 * i}\n' for i in range(1, rows + 1)))
+    return file_name
+
+
+def test_truncated_sidecar_is_written_again(tmp_path):
+    file_name = price_file(tmp_path)
+    load_price_file(file_name)
+    with open(file_name + SIDECAR_PRICES_SUFFIX, 'r+b') as sidecar:
+        sidecar.truncate(200)
+
+    symbols, prices = load_price_file(file_name)
+
+    assert symbols == ['AAA', 'BBB']
+    np.testing.assert_array_equal(prices[-1], [500, 1000])
+
+
+def test_damaged_sidecar_meta_is_written_again(tmp_path):
+    file_name = price_file(tmp_path)
+    load_price_file(file_name)
+    with open(file_name + SIDECAR_META_SUFFIX, 'w') as meta_file:
+        meta_file.write('{"symbols": [')
+
+    symbols, prices = load_price_file(file_name)
+
+    assert symbols == ['AAA', 'BBB']
+    assert prices.shape == (500, 2)
@@ -0,0 +1,148 @@
+import pandas as pd
+import numpy as np
+import time
+import os
+
+from price_cache import PriceHistoryCache, CACHE_META_FILE, CACHE_COLUMN_FILES
+from providers import LocalFakeProvider
+
+
+def history(end, periods, start_price=100):
+    dates = pd.date_range(end=end, periods=periods, freq='D')
+    close = start_price + np.arange(periods, dtype=np.float64)
+    return pd.DataFrame({'Close': close, 'Dividends': np.zeros(periods), 'Stock Splits': np.zeros(periods)},
+                        index=dates)
+
+
+def today():
+    return pd.Timestamp.today().normalize()
+
+
+def test_second_read_is_served_from_cache(tmp_path):
+    provider = LocalFakeProvider({'AAA': history(today(), 60)})
+    cache = PriceHistoryCache(str(tmp_path))
+
+    first = cache.history(provider, 'AAA', '1d', 30)
+    second = cache.history(provider, 'AAA', '1d', 30)
+
+    assert len(provider.requests) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert second.index.equals(first.index)
+    np.testing.assert_array_equal(second['Close'].to_numpy(), first['Close'].to_numpy())
+
+
+def test_stale_entry_fetches_only_newer_bars(tmp_path):
+    full = history(today(), 60)
+    provider = LocalFakeProvider({'AAA': full.iloc[:-3]})
+    cache = PriceHistoryCache(str(tmp_path), refresh_after_seconds=0)
+    cache.history(provider, 'AAA', '1d', 30)
+
+    provider.histories['AAA'] = full
+    time.sleep(0.01)
+    refreshed = cache.history(provider, 'AAA', '1d', 30)
+
+    symbol, interval, period, start = provider.requests[-1]
+    assert period is None
+    # the last cached bar is fetched again (it may have been in progress) with the complete one before it
+    assert pd.Timestamp(start) == full.index[-5]
+    assert refreshed.index[-1] == full.index[-1]
+    assert not refreshed.index.duplicated().any()
+    np.testing.assert_array_equal(refreshed['Close'].to_numpy(), full['Close'].to_numpy()[-len(refreshed):])
+
+
+def test_series_adjusted_for_split_is_fetched_again(tmp_path):
+    full = history(today(), 60)
+    provider = LocalFakeProvider({'AAA': full.iloc[:-3]})
+    cache = PriceHistoryCache(str(tmp_path), refresh_after_seconds=0)
+    cache.history(provider, 'AAA', '1d', 30)
+
+    # 4:1 split today, the provider divides every earlier close by 4
+    adjusted = full.copy()
+    adjusted.iloc[:-1, adjusted.columns.get_loc('Close')] /= 4
+    adjusted.iloc[-1, adjusted.columns.get_loc('Stock Splits')] = 4
+    provider.histories['AAA'] = adjusted
+    time.sleep(0.01)
+    refreshed = cache.history(provider, 'AAA', '1d', 30)
+
+    assert provider.requests[-1][2] == '30d'
+    np.testing.assert_array_equal(refreshed['Close'].to_numpy(), adjusted['Close'].to_numpy()[-len(refreshed):])
+
+
+def test_dividend_in_newer_bars_refetches_the_window(tmp_path):
+    full = history(today(), 60)
+    provider = LocalFakeProvider({'AAA': full.iloc[:-3]})
+    cache = PriceHistoryCache(str(tmp_path), refresh_after_seconds=0)
+    cache.history(provider, 'AAA', '1d', 30)
+
+    with_dividend = full.copy()
+    with_dividend.iloc[-2, with_dividend.columns.get_loc('Dividends')] = 0.5
+    provider.histories['AAA'] = with_dividend
+    time.sleep(0.01)
+    cache.history(provider, 'AAA', '1d', 30)
+
+    assert provider.requests[-1][2] == '30d'
+
+
+def test_longer_window_than_cached_is_fetched_again(tmp_path):
+    provider = LocalFakeProvider({'AAA': history(today(), 200)})
+    cache = PriceHistoryCache(str(tmp_path))
+    cache.history(provider, 'AAA', '1d', 30)
+
+    longer = cache.history(provider, 'AAA', '1d', 100)
+
+    assert provider.requests[-1][2] == '100d'
+    assert len(longer) == 100
+
+
+def test_entry_without_meta_is_fetched_again(tmp_path):
+    provider = LocalFakeProvider({'AAA': history(today(), 60)})
+    cache = PriceHistoryCache(str(tmp_path))
+    cache.history(provider, 'AAA', '1d', 30)
+    os.remove(os.path.join(cache._entry_dir('AAA', '1d'), CACHE_META_FILE))
+
+    cache.history(provider, 'AAA', '1d', 30)
+
+    assert len(provider.requests) == 2
+
+
+def test_corrupt_entry_is_fetched_again(tmp_path):
+    provider = LocalFakeProvider({'AAA': history(today(), 60)})
+    cache = PriceHistoryCache(str(tmp_path))
+    expected = cache.history(provider, 'AAA', '1d', 30)
+    with open(os.path.join(cache._entry_dir('AAA', '1d'), CACHE_COLUMN_FILES['Close']), 'wb') as close_file:
+        close_file.write(b'not an array')
+
+    fetched_again = cache.history(provider, 'AAA', '1d', 30)
+
+    assert len(provider.requests) == 2
+    np.testing.assert_array_equal(fetched_again['Close'].to_numpy(), expected['Close'].to_numpy())
+
+
+def test_torn_entry_is_fetched_again(tmp_path):
+    provider = LocalFakeProvider({'AAA': history(today(), 60)})
+    cache = PriceHistoryCache(str(tmp_path))
+    cache.history(provider, 'AAA', '1d', 30)
+    np.save(os.path.join(cache._entry_dir('AAA', '1d'), CACHE_COLUMN_FILES['Close']), np.ones(5))
+
+    cache.history(provider, 'AAA', '1d', 30)
+
+    assert len(provider.requests) == 2
+
+
+def test_evict_drops_old_entries_then_least_recently_used(tmp_path):
+    provider = LocalFakeProvider({symbol: history(today(), 60) for symbol in ['AAA', 'BBB', 'CCC']})
+    cache = PriceHistoryCache(str(tmp_path), max_age_days=30)
+    for symbol in ['AAA', 'BBB', 'CCC']:
+        cache.history(provider, symbol, '1d', 30)
+    month_ago = time.time() - 31 * 24 * 3600
+    os.utime(os.path.join(cache._entry_dir('AAA', '1d'), CACHE_META_FILE), (month_ago, month_ago))
+    os.utime(os.path.join(cache._entry_dir('BBB', '1d'), CACHE_META_FILE), (time.time() - 60, time.time() - 60))
+
+    cache.evict()
+    assert not os.path.exists(cache._entry_dir('AAA', '1d'))
+    assert os.path.exists(cache._entry_dir('BBB', '1d'))
+
+    cache.max_bytes = max(size for _, size, _ in cache.entries())
+    cache.evict()
+    assert not os.path.exists(cache._entry_dir('BBB', '1d'))
+    assert os.path.exists(cache._entry_dir('CCC', '1d'))
@@ -0,0 +1,16 @@
+import numpy as np
+
+from covariance import FactorCovariance
+from simulation import simulate_portfolio
+
+
+def test_results_do_not_depend_on_amount_of_processes():
+    returns = np.random.default_rng(0).normal(0.1, 1.0, (200, 30))
+    investments = np.full(30, 10.0)
+    for cov in [np.cov(returns.T), FactorCovariance(returns, 3)]:
+        serial = simulate_portfolio(returns.mean(axis=0), cov, investments, 100, 0.01, periods=5, n_paths=300000,
+                                    seed=1, processes=1)
+        parallel = simulate_portfolio(returns.mean(axis=0), cov, investments, 100, 0.01, periods=5, n_paths=300000,
+                                      seed=1, processes=2)
+
+        np.testing.assert_array_equal(serial.final_values, parallel.final_values)
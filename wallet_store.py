@@ -0,0 +1,164 @@
+import pandas as pd
+import numpy as np
+import pickle as pkl
+import json
+import time
+import os
+
+from panel import PricePanel
+from price_cache import REFRESH_AFTER_SECONDS
+
+WALLET_FORMAT = 'the-wallet'
+# 2: numeric stages are saved per return interval
+WALLET_SCHEMA_VERSION = 2
+WALLET_SETTINGS = ['k_risk_factor', 'risk_free_asset_expected_return', 'time_horizon_in_days', 'n_days_return_str',
+                   'n_days_return', 'n_days_return_as_a_years_part', 'budget', 'covariance_model', 'n_factors',
+                   'panel_dtype', 'file_mode_on', 'long_only', 'max_asset_weight', 'max_leverage']
+PANEL_ARRAYS = ['close', 'dividends', 'splits']
+# dense numeric stages worth keeping, everything else is cheap to recompute
+SAVED_ARRAY_STAGES = ['mean', 'cov']
+
+
+class WalletFormatError(Exception):
+    """Raised when a file is not a wallet saved in the current format"""
+
+
+def arrays_dir(wallet_path):
+    return wallet_path + '.data'
+
+
+def save_array(wallet_path, name, array):
+    """Writes through a temporary file, arrays of the previous save may still be memory-mapped"""
+    file_name = name + '.npy'
+    tmp_path = os.path.join(arrays_dir(wallet_path), f'.{file_name}.tmp')
+    with open(tmp_path, 'wb') as array_file:
+        np.save(array_file, np.asarray(array))
+    os.replace(tmp_path, os.path.join(arrays_dir(wallet_path), file_name))
+    return file_name
+
+
+def load_array(wallet_path, file_name):
+    """Memory-mapped, nothing but the header is read until the values are used"""
+    return np.load(os.path.join(arrays_dir(wallet_path), file_name), mmap_mode='r')
+
+
+def save_panel(wallet_path, name, panel):
+    manifest = {'symbols': panel.symbols, 'dtype': panel.dtype.str, 'arrays': {}}
+    if isinstance(panel.index, pd.DatetimeIndex):
+        manifest['index'] = save_array(wallet_path, f'{name}.index', panel.index.to_numpy(dtype='datetime64[ns]'))
+    else:
+        manifest['index_length'] = len(panel.index)
+    for array_name in PANEL_ARRAYS:
+        if getattr(panel, array_name) is not None:
+            manifest['arrays'][array_name] = save_array(wallet_path, f'{name}.{array_name}', getattr(panel, array_name))
+    return manifest
+
+
+def load_panel(wallet_path, manifest):
+    if 'index' in manifest:
+        index = pd.DatetimeIndex(load_array(wallet_path, manifest['index']))
+    else:
+        index = pd.RangeIndex(manifest['index_length'])
+    arrays = {name: load_array(wallet_path, file_name) for name, file_name in manifest['arrays'].items()}
+    return PricePanel(index, manifest['symbols'], arrays['close'], arrays.get('dividends'), arrays.get('splits'),
+                      dtype=manifest['dtype'])
+
+
+def save_wallet(wallet, wallet_path):
+    """Settings and stocks go to a small JSON file, numeric data to .npy files in `<wallet_path>.data`"""
+    os.makedirs(arrays_dir(wallet_path), exist_ok=True)
+    wallet_data = {'format': WALLET_FORMAT,
+                   'schema_version': WALLET_SCHEMA_VERSION,
+                   'settings': {name: getattr(wallet, name) for name in WALLET_SETTINGS},
+                   'stocks': [{'symbol': stock.info['symbol'], 'shortName': stock.info['shortName']}
+                              for stock in wallet.stocks],
+                   'panels': {}, 'stages': {}}
+    if wallet.file_prices is not None:
+        wallet_data['panels']['file_prices'] = save_panel(wallet_path, 'file_prices', wallet.file_prices)
+    # file mode prices stage is the file_prices panel itself
+    if wallet.stages.is_cached('prices') and not wallet.file_mode_on:
+        wallet_data['panels']['prices'] = save_panel(wallet_path, 'prices', wallet.stages.cached('prices')[None])
+        wallet_data['prices_fetched_at'] = wallet.prices_fetched_at
+    for stage in SAVED_ARRAY_STAGES:
+        for interval, result in wallet.stages.cached(stage).items():
+            if isinstance(result, np.ndarray):
+                wallet_data['stages'].setdefault(stage, {})[interval] = \
+                    save_array(wallet_path, f'stage.{stage}.{interval}', result)
+
+    tmp_path = wallet_path + '.tmp'
+    with open(tmp_path, 'w') as wallet_file:
+        json.dump(wallet_data, wallet_file, indent=2)
+    os.replace(tmp_path, wallet_path)
+
+    used_files = {file_name for panel in wallet_data['panels'].values()
+                  for file_name in [panel.get('index'), *panel['arrays'].values()] if file_name}
+    used_files.update(file_name for stage_files in wallet_data['stages'].values() for file_name in stage_files.values())
+    for file_name in os.listdir(arrays_dir(wallet_path)):
+        if file_name not in used_files and not file_name.startswith('.'):
+            os.remove(os.path.join(arrays_dir(wallet_path), file_name))
+
+
+def read_wallet_data(wallet_path):
+    try:
+        with open(wallet_path) as wallet_file:
+            wallet_data = json.load(wallet_file)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise WalletFormatError(f'{wallet_path} is not a wallet file of the current format')
+    if not isinstance(wallet_data, dict) or wallet_data.get('format') != WALLET_FORMAT:
+        raise WalletFormatError(f'{wallet_path} is not a wallet file of the current format')
+    if wallet_data['schema_version'] > WALLET_SCHEMA_VERSION:
+        raise WalletFormatError(f'{wallet_path} was saved by a newer version of the-wallet '
+                                f'(schema {wallet_data["schema_version"]})')
+    return wallet_data
+
+
+def load_wallet(wallet_path):
+    """Reads the JSON part only, numeric data are memory-mapped and read when first used"""
+    from functions import Wallet, Stock, ApiStock
+    wallet_data = read_wallet_data(wallet_path)
+    wallet = Wallet()
+    for name, value in wallet_data['settings'].items():
+        if name in WALLET_SETTINGS:
+            setattr(wallet, name, value)
+    wallet.stocks = [Stock(info['symbol']) if wallet.file_mode_on else ApiStock(info) for info in wallet_data['stocks']]
+    if 'file_prices' in wallet_data['panels']:
+        wallet.file_prices = load_panel(wallet_path, wallet_data['panels']['file_prices'])
+    fetched_at = wallet_data.get('prices_fetched_at')
+    if not wallet.file_mode_on and (fetched_at is None or time.time() - fetched_at > REFRESH_AFTER_SECONDS):
+        # downloaded prices and everything computed from them are outdated, fetched again through the price cache
+        return wallet
+    if 'prices' in wallet_data['panels']:
+        wallet.stages.set('prices', load_panel(wallet_path, wallet_data['panels']['prices']))
+        wallet.prices_fetched_at = fetched_at
+    for stage, stage_files in wallet_data['stages'].items():
+        if wallet_data['schema_version'] == 1:
+            # single result computed for the interval the wallet was set to
+            stage_files = {wallet.n_days_return_str: stage_files}
+        for interval, file_name in stage_files.items():
+            wallet.stages.set(stage, load_array(wallet_path, file_name), key=interval)
+    return wallet
+
+
+def load_legacy_wallet(wallet_path):
+    """Converts a whole-object pickle of older versions, unpickling runs code so only for trusted files"""
+    from functions import Wallet, Stock, ApiStock
+    with open(wallet_path, 'rb') as wallet_pickle:
+        legacy_wallet = pkl.load(wallet_pickle)
+    wallet = Wallet()
+    for name in WALLET_SETTINGS:
+        if hasattr(legacy_wallet, name):
+            setattr(wallet, name, getattr(legacy_wallet, name))
+    if wallet.file_mode_on:
+        wallet.stocks = [Stock(stock.info['symbol']) for stock in legacy_wallet.stocks]
+        if legacy_wallet.stocks and hasattr(legacy_wallet.stocks[0], 'pricing_info'):
+            wallet.file_prices = PricePanel.from_prices(
+                [stock.info['symbol'] for stock in legacy_wallet.stocks],
+                np.column_stack([stock.pricing_info['Close'].to_numpy(dtype=np.float64)
+                                 for stock in legacy_wallet.stocks]))
+        else:
+            wallet.file_prices = getattr(legacy_wallet, 'file_prices', None)
+    else:
+        wallet.stocks = [ApiStock({'symbol': stock.info['symbol'],
+                                   'shortName': stock.info.get('shortName', stock.info['symbol'])})
+                         for stock in legacy_wallet.stocks]
+    return wallet